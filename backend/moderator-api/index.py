@@ -1,7 +1,53 @@
+import io
 import json
 import os
+import random
+import time
 import psycopg2
-from typing import Optional
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from psycopg2 import pool as pg_pool
+from psycopg2 import extensions as pg_extensions
+from datetime import datetime, timedelta
+from typing import Optional, Dict, Iterable, Callable, Union, List
+
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_HEALTHCHECK_IDLE_SECONDS = 30
+
+# Пул живёт на уровне модуля и переиспользуется тёплыми вызовами функции
+_db_pool = None
+_db_pool_key = None
+_db_last_used: Dict[int, float] = {}
+
+PAGE_SIZE_DEFAULT = 50
+PAGE_SIZE_MAX = 500
+EXPORT_BATCH_SIZE = 1000
+BATCH_MAX_IDS = 1000
+MODERATION_LEASE = timedelta(minutes=5)
+
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+TELEGRAM_TIMEOUT = (3.05, 10)
+TELEGRAM_SEND_WORKERS = 8
+
+# Параметры исходящей очереди совпадают с ботом: бюджет в outbox_rate общий для всех отправителей
+OUTBOX_MESSAGES_PER_SECOND = 25
+OUTBOX_BURST = 5
+OUTBOX_CHAT_INTERVAL = timedelta(seconds=1)
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_LEASE = timedelta(seconds=60)
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_MAX_BACKOFF = 600
+OUTBOX_BUDGET_SQL = "LEAST(%(burst)s, tokens + GREATEST(EXTRACT(EPOCH FROM NOW() - refilled_at), 0) * %(rate)s)"
+NOTIFY_SECONDS = float(os.environ.get('NOTIFY_SECONDS', '10'))
+
+APPROVED_MESSAGE = "✅ Твоя анкета одобрена!\n\nТеперь ты можешь смотреть анкеты командой /browse"
+REJECTED_MESSAGE = (
+    "❌ Твоя анкета отклонена.\n\nВозможные причины:\n- Неподходящее фото\n- Некорректные данные\n\n"
+    "Создай новую анкету командой /create"
+)
+
+_telegram_session: Optional[requests.Session] = None
 
 def handler(event: dict, context) -> dict:
     """
@@ -21,127 +67,323 @@ def handler(event: dict, context) -> dict:
         if not db_url:
             return cors_response(500, {'error': 'Database not configured'})
         
-        conn = psycopg2.connect(db_url, options=f'-c search_path={schema}')
-        conn.autocommit = True
-        cursor = conn.cursor()
-        
-        action = path.get('action', '')
+        conn = acquire_connection(db_url, schema)
+        broken = False
+        try:
+            cursor = conn.cursor()
+            result = route_request(method, path.get('action', ''), event, cursor)
+            cursor.close()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            release_connection(conn, broken)
         
-        if method == 'GET':
-            if action == 'pending_profiles':
-                result = get_pending_profiles(cursor)
-            elif action == 'reports':
-                result = get_reports(cursor)
-            elif action == 'stats':
-                result = get_stats(cursor)
-            else:
-                result = {'error': 'Unknown action'}
+        if isinstance(result, str):
+            return cors_json_response(200, result)
+        return cors_response(200, result)
         
-        elif method == 'POST':
-            body = json.loads(event.get('body', '{}'))
-            
-            if action == 'approve':
-                result = approve_profile(cursor, body.get('profile_id'))
-            elif action == 'reject':
-                result = reject_profile(cursor, body.get('profile_id'))
-            elif action == 'resolve_report':
-                result = resolve_report(cursor, body.get('report_id'))
-            elif action == 'dismiss_report':
-                result = dismiss_report(cursor, body.get('report_id'))
-            else:
-                result = {'error': 'Unknown action'}
+    except Exception as e:
+        return cors_response(500, {'error': str(e)})
+
+
+def route_request(method: str, action: str, event: dict, cursor) -> Union[dict, str]:
+    """Выбрать обработчик по методу и action; строка — уже готовое JSON-тело"""
+    if method == 'GET':
+        params = event.get('queryStringParameters') or {}
         
+        if action == 'pending_profiles':
+            result = get_pending_profiles(cursor, params.get('after'), params.get('limit'), params.get('moderator_id'))
+        elif action == 'reports':
+            result = get_reports(cursor, params.get('after'), params.get('limit'), params.get('moderator_id'))
+        elif action == 'export_pending_profiles':
+            result = export_pending_profiles(cursor)
+        elif action == 'export_reports':
+            result = export_reports(cursor)
+        elif action == 'stats':
+            result = get_stats(cursor)
         else:
-            result = {'error': 'Method not allowed'}
+            result = {'error': 'Unknown action'}
+    
+    elif method == 'POST':
+        body = json.loads(event.get('body', '{}'))
         
-        cursor.close()
-        conn.close()
+        if action == 'approve':
+            result = approve_profile(cursor, body.get('profile_id'), body.get('moderator_id'))
+        elif action == 'reject':
+            result = reject_profile(cursor, body.get('profile_id'), body.get('moderator_id'))
+        elif action == 'resolve_report':
+            result = update_report(cursor, body.get('report_id'), 'resolved', body.get('moderator_id'))
+        elif action == 'dismiss_report':
+            result = update_report(cursor, body.get('report_id'), 'dismissed', body.get('moderator_id'))
+        elif action == 'claim_profile':
+            result = claim_profile(cursor, body.get('moderator_id'))
+        elif action == 'claim_report':
+            result = claim_report(cursor, body.get('moderator_id'))
+        elif action == 'approve_batch':
+            result = approve_profiles_batch(cursor, body.get('profile_ids'), body.get('moderator_id'))
+        elif action == 'reject_batch':
+            result = reject_profiles_batch(cursor, body.get('profile_ids'), body.get('moderator_id'))
+        elif action == 'resolve_reports':
+            result = update_reports_batch(cursor, body.get('report_ids'), 'resolved', body.get('moderator_id'))
+        elif action == 'dismiss_reports':
+            result = update_reports_batch(cursor, body.get('report_ids'), 'dismissed', body.get('moderator_id'))
+        else:
+            result = {'error': 'Unknown action'}
+    
+    else:
+        result = {'error': 'Method not allowed'}
+
+    return result
+
+
+def get_db_pool(db_url: str, schema: str):
+    """Получить пул соединений, создав его при первом вызове"""
+    global _db_pool, _db_pool_key
+    
+    key = (db_url, schema)
+    if _db_pool is not None and not _db_pool.closed and _db_pool_key == key:
+        return _db_pool
+    
+    if _db_pool is not None and not _db_pool.closed:
+        _db_pool.closeall()
+    
+    _db_pool = None
+    _db_last_used.clear()
+    _db_pool = pg_pool.ThreadedConnectionPool(
+        1, DB_POOL_MAX_SIZE, db_url, options=f'-c search_path={schema}'
+    )
+    _db_pool_key = key
+    return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    """Проверить соединение, если оно долго простаивало в пуле"""
+    if conn.closed:
+        return False
+    
+    last_used = _db_last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_HEALTHCHECK_IDLE_SECONDS:
+        return True
+    
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def acquire_connection(db_url: str, schema: str):
+    """Взять живое соединение из пула, переподключаясь при сбое"""
+    for attempt in range(DB_POOL_MAX_SIZE + 1):
+        try:
+            db_pool = get_db_pool(db_url, schema)
+            conn = db_pool.getconn()
+        except psycopg2.OperationalError:
+            if _db_pool is not None and not _db_pool.closed:
+                _db_pool.closeall()
+            if attempt > 0:
+                raise
+            continue
         
-        return cors_response(200, result)
+        if is_connection_healthy(conn):
+            if not conn.autocommit:
+                conn.autocommit = True
+            return conn
         
-    except Exception as e:
-        return cors_response(500, {'error': str(e)})
+        _db_last_used.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+    
+    raise psycopg2.OperationalError('No healthy database connection available')
 
 
-def get_pending_profiles(cursor) -> dict:
-    """Получить анкеты на модерации"""
-    cursor.execute(
-        """SELECT id, telegram_id, username, name, age, city, gender, photo_url, bio, created_at
-           FROM profiles 
-           WHERE status = 'pending'
-           ORDER BY created_at DESC"""
-    )
+def release_connection(conn, broken: bool = False):
+    """Вернуть соединение в пул или закрыть сломанное"""
+    close = broken or conn.closed
     
-    rows = cursor.fetchall()
-    profiles = []
-    
-    for row in rows:
-        profiles.append({
-            'id': row[0],
-            'telegram_id': row[1],
-            'username': row[2],
-            'name': row[3],
-            'age': row[4],
-            'city': row[5],
-            'gender': row[6],
-            'photo_url': row[7],
-            'bio': row[8],
-            'created_at': row[9].isoformat() if row[9] else None
-        })
-    
-    return {'profiles': profiles}
-
-
-def get_reports(cursor) -> dict:
-    """Получить активные жалобы"""
-    cursor.execute(
-        """SELECT r.id, r.reporter_id, r.reported_user_id, r.reason, r.status, r.created_at,
+    if not close and conn.get_transaction_status() != pg_extensions.TRANSACTION_STATUS_IDLE:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            close = True
+    
+    if _db_pool is None or _db_pool.closed:
+        if not conn.closed:
+            conn.close()
+        return
+    
+    if close:
+        _db_last_used.pop(id(conn), None)
+    else:
+        _db_last_used[id(conn)] = time.monotonic()
+    
+    _db_pool.putconn(conn, close=close)
+
+
+PENDING_PROFILES_SQL = """SELECT id, telegram_id, username, name, age, city, gender, photo_url, bio, created_at
+           FROM profiles
+           WHERE status = 'pending' {filters}
+           ORDER BY created_at DESC, id DESC"""
+
+PENDING_REPORTS_SQL = """SELECT r.id, r.reporter_id, r.reported_user_id, r.reason, r.status, r.created_at,
                   p1.name as reporter_name, p2.name as reported_name, p2.telegram_id
            FROM reports r
            JOIN profiles p1 ON r.reporter_id = p1.telegram_id
            JOIN profiles p2 ON r.reported_user_id = p2.telegram_id
-           WHERE r.status = 'pending'
-           ORDER BY r.created_at DESC"""
+           WHERE r.status = 'pending' {filters}
+           ORDER BY r.created_at DESC, r.id DESC"""
+
+
+def get_pending_profiles(cursor, after: Optional[str] = None, limit: Optional[str] = None,
+                         moderator_id: Optional[str] = None) -> Union[dict, str]:
+    """Получить страницу свободных анкет на модерации"""
+    return fetch_page(cursor, PENDING_PROFILES_SQL, '', 'created_at, id', 'profiles', profile_to_dict,
+                      after, limit, moderator_id)
+
+
+def get_reports(cursor, after: Optional[str] = None, limit: Optional[str] = None,
+                moderator_id: Optional[str] = None) -> Union[dict, str]:
+    """Получить страницу свободных активных жалоб"""
+    return fetch_page(cursor, PENDING_REPORTS_SQL, 'r.', 'r.created_at, r.id', 'reports', report_to_dict,
+                      after, limit, moderator_id)
+
+
+def export_pending_profiles(cursor) -> str:
+    """Выгрузить все анкеты на модерации"""
+    return export_rows(cursor, PENDING_PROFILES_SQL.format(filters=''), 'profiles', profile_to_dict)
+
+
+def export_reports(cursor) -> str:
+    """Выгрузить все активные жалобы"""
+    return export_rows(cursor, PENDING_REPORTS_SQL.format(filters=''), 'reports', report_to_dict)
+
+
+def fetch_page(cursor, query: str, alias: str, keyset_columns: str, key: str, to_dict: Callable[[tuple], dict],
+               after: Optional[str], limit: Optional[str], moderator_id: Optional[str] = None) -> Union[dict, str]:
+    """
+    Страница по ключу (created_at, id): следующая начинается после последней строки.
+    Строки в работе у других модераторов не показываются, чтобы двое не разбирали одно и то же.
+    """
+    try:
+        page_size = min(max(int(limit), 1), PAGE_SIZE_MAX) if limit else PAGE_SIZE_DEFAULT
+        keyset = parse_keyset(after) if after else None
+    except ValueError:
+        return {'error': 'Invalid pagination parameters'}
+    
+    try:
+        moderator_id = int(moderator_id) if moderator_id else None
+    except ValueError:
+        return {'error': 'Invalid moderator ID'}
+    
+    filters = f"AND {unclaimed_sql(alias)}"
+    if keyset:
+        filters += f" AND ({keyset_columns}) < (%(after_created)s, %(after_id)s)"
+    
+    cursor.execute(
+        query.format(filters=filters) + " LIMIT %(limit)s",
+        {
+            'moderator_id': moderator_id,
+            'after_created': keyset[0] if keyset else None,
+            'after_id': keyset[1] if keyset else None,
+            'limit': page_size + 1
+        }
     )
     
     rows = cursor.fetchall()
-    reports = []
-    
-    for row in rows:
-        reports.append({
-            'id': row[0],
-            'reporter_id': row[1],
-            'reported_user_id': row[2],
-            'reason': row[3],
-            'status': row[4],
-            'created_at': row[5].isoformat() if row[5] else None,
-            'reporter_name': row[6],
-            'reported_name': row[7],
-            'reported_telegram_id': row[8]
-        })
+    next_after = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = to_dict(rows[-1])
+        next_after = f"{last['created_at']},{last['id']}"
     
-    return {'reports': reports}
+    return encode_json_list(key, (to_dict(row) for row in rows), {'next_after': next_after})
 
 
-def get_stats(cursor) -> dict:
-    """Получить статистику бота"""
-    cursor.execute("SELECT COUNT(*) FROM profiles WHERE status = 'approved'")
-    approved_count = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM profiles WHERE status = 'pending'")
-    pending_count = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM profiles WHERE status = 'rejected'")
-    rejected_count = cursor.fetchone()[0]
+def export_rows(cursor, query: str, key: str, to_dict: Callable[[tuple], dict]) -> str:
+    """Выгрузка через серверный курсор: строки читаются пачками, а не fetchall"""
+    conn = cursor.connection
+    conn.autocommit = False
+    try:
+        with conn.cursor(name=f'export_{key}') as named_cursor:
+            named_cursor.itersize = EXPORT_BATCH_SIZE
+            named_cursor.execute(query)
+            return encode_json_list(key, (to_dict(row) for row in named_cursor))
+    finally:
+        conn.rollback()
+        conn.autocommit = True
+
+
+def unclaimed_sql(alias: str = '') -> str:
+    """Условие «строка свободна»: аренды нет, она истекла или принадлежит %(moderator_id)s"""
+    return (f"({alias}claimed_until IS NULL OR {alias}claimed_until < NOW()"
+            f" OR {alias}claimed_by = %(moderator_id)s)")
+
+
+def parse_keyset(after: str) -> tuple:
+    """Разобрать курсор вида <created_at>,<id>"""
+    created_at, _, row_id = after.rpartition(',')
+    return datetime.fromisoformat(created_at), int(row_id)
+
+
+def encode_json_list(key: str, items: Iterable[dict], extra: Optional[dict] = None) -> str:
+    """Собрать JSON {key: [...]} по одному элементу, без промежуточного списка словарей"""
+    buffer = io.StringIO()
+    buffer.write('{' + json.dumps(key) + ': [')
     
-    cursor.execute("SELECT COUNT(*) FROM matches")
-    matches_count = cursor.fetchone()[0]
+    for index, item in enumerate(items):
+        if index:
+            buffer.write(', ')
+        buffer.write(json.dumps(item, ensure_ascii=False))
     
-    cursor.execute("SELECT COUNT(*) FROM reports WHERE status = 'pending'")
-    reports_count = cursor.fetchone()[0]
+    buffer.write(']')
+    for name, value in (extra or {}).items():
+        buffer.write(', ' + json.dumps(name) + ': ' + json.dumps(value, ensure_ascii=False))
+    buffer.write('}')
     
-    cursor.execute("SELECT COUNT(*) FROM likes WHERE created_at > NOW() - INTERVAL '24 hours'")
-    likes_today = cursor.fetchone()[0]
+    return buffer.getvalue()
+
+
+def profile_to_dict(row: tuple) -> dict:
+    """Анкета для панели"""
+    return {
+        'id': row[0],
+        'telegram_id': row[1],
+        'username': row[2],
+        'name': row[3],
+        'age': row[4],
+        'city': row[5],
+        'gender': row[6],
+        'photo_url': row[7],
+        'bio': row[8],
+        'created_at': row[9].isoformat() if row[9] else None
+    }
+
+
+def report_to_dict(row: tuple) -> dict:
+    """Жалоба для панели"""
+    return {
+        'id': row[0],
+        'reporter_id': row[1],
+        'reported_user_id': row[2],
+        'reason': row[3],
+        'status': row[4],
+        'created_at': row[5].isoformat() if row[5] else None,
+        'reporter_name': row[6],
+        'reported_name': row[7],
+        'reported_telegram_id': row[8]
+    }
+
+
+def get_stats(cursor) -> dict:
+    """Получить статистику бота"""
+    cursor.execute(
+        """SELECT c.approved_profiles, c.pending_profiles, c.rejected_profiles, c.matches, c.pending_reports,
+                  (SELECT COALESCE(SUM(h.likes), 0) FROM likes_hourly h
+                   WHERE h.bucket > NOW() - INTERVAL '24 hours')
+           FROM stats_counters c"""
+    )
+    approved_count, pending_count, rejected_count, matches_count, reports_count, likes_today = cursor.fetchone()
     
     return {
         'total_profiles': approved_count + pending_count + rejected_count,
@@ -154,68 +396,360 @@ def get_stats(cursor) -> dict:
     }
 
 
-def approve_profile(cursor, profile_id: int) -> dict:
+def claim_profile(cursor, moderator_id: int) -> dict:
+    """Взять в работу самую старую свободную анкету на модерации"""
+    if moderator_id is None:
+        return {'error': 'Moderator ID required'}
+    
+    # SKIP LOCKED и аренда не дают двум модераторам получить одну анкету
+    cursor.execute(
+        f"""UPDATE profiles SET claimed_by = %(moderator_id)s, claimed_until = NOW() + %(lease)s
+           WHERE id = (
+               SELECT id FROM profiles
+               WHERE status = 'pending'
+               AND {unclaimed_sql()}
+               ORDER BY created_at
+               LIMIT 1
+               FOR UPDATE SKIP LOCKED
+           )
+           RETURNING id, telegram_id, username, name, age, city, gender, photo_url, bio, created_at""",
+        {'moderator_id': moderator_id, 'lease': MODERATION_LEASE}
+    )
+    
+    row = cursor.fetchone()
+    return {'profile': profile_to_dict(row) if row else None}
+
+
+def claim_report(cursor, moderator_id: int) -> dict:
+    """Взять в работу самую старую свободную жалобу"""
+    if moderator_id is None:
+        return {'error': 'Moderator ID required'}
+    
+    cursor.execute(
+        f"""WITH claimed AS (
+               UPDATE reports SET claimed_by = %(moderator_id)s, claimed_until = NOW() + %(lease)s
+               WHERE id = (
+                   SELECT id FROM reports
+                   WHERE status = 'pending'
+                   AND {unclaimed_sql()}
+                   ORDER BY created_at
+                   LIMIT 1
+                   FOR UPDATE SKIP LOCKED
+               )
+               RETURNING id, reporter_id, reported_user_id, reason, status, created_at
+           )
+           SELECT c.id, c.reporter_id, c.reported_user_id, c.reason, c.status, c.created_at,
+                  p1.name as reporter_name, p2.name as reported_name, p2.telegram_id
+           FROM claimed c
+           LEFT JOIN profiles p1 ON c.reporter_id = p1.telegram_id
+           LEFT JOIN profiles p2 ON c.reported_user_id = p2.telegram_id""",
+        {'moderator_id': moderator_id, 'lease': MODERATION_LEASE}
+    )
+    
+    row = cursor.fetchone()
+    return {'report': report_to_dict(row) if row else None}
+
+
+def approve_profile(cursor, profile_id: int, moderator_id: Optional[int] = None) -> dict:
     """Одобрить анкету"""
     if not profile_id:
         return {'error': 'Profile ID required'}
     
     cursor.execute(
-        "UPDATE profiles SET status = 'approved', updated_at = NOW() WHERE id = %s RETURNING telegram_id",
-        (profile_id,)
+        f"""UPDATE profiles SET status = 'approved', updated_at = NOW()
+           WHERE id = %(id)s AND status = 'pending' AND {unclaimed_sql()}
+           RETURNING telegram_id""",
+        {'id': profile_id, 'moderator_id': moderator_id}
     )
     
     result = cursor.fetchone()
     if not result:
-        return {'error': 'Profile not found'}
+        return {'error': 'Profile not found, already processed or claimed by another moderator'}
     
     return {'success': True, 'telegram_id': result[0]}
 
 
-def reject_profile(cursor, profile_id: int) -> dict:
+def reject_profile(cursor, profile_id: int, moderator_id: Optional[int] = None) -> dict:
     """Отклонить анкету"""
     if not profile_id:
         return {'error': 'Profile ID required'}
     
     cursor.execute(
-        "UPDATE profiles SET status = 'rejected', updated_at = NOW() WHERE id = %s RETURNING telegram_id",
-        (profile_id,)
+        f"""UPDATE profiles SET status = 'rejected', updated_at = NOW()
+           WHERE id = %(id)s AND status = 'pending' AND {unclaimed_sql()}
+           RETURNING telegram_id""",
+        {'id': profile_id, 'moderator_id': moderator_id}
     )
     
     result = cursor.fetchone()
     if not result:
-        return {'error': 'Profile not found'}
+        return {'error': 'Profile not found, already processed or claimed by another moderator'}
+    
+    invalidate_browse_queue(cursor, result[0])
     
     return {'success': True, 'telegram_id': result[0]}
 
 
-def resolve_report(cursor, report_id: int) -> dict:
-    """Разрешить жалобу (принять меры)"""
+def invalidate_browse_queue(cursor, telegram_id: int):
+    """Убрать анкету из очередей просмотра всех пользователей"""
+    cursor.execute("DELETE FROM browse_queue WHERE candidate_id = %s", (telegram_id,))
+
+
+def update_report(cursor, report_id: int, status: str, moderator_id: Optional[int] = None) -> dict:
+    """Закрыть жалобу с указанным статусом"""
     if not report_id:
         return {'error': 'Report ID required'}
     
     cursor.execute(
-        "UPDATE reports SET status = 'resolved' WHERE id = %s",
-        (report_id,)
+        f"""UPDATE reports SET status = %(status)s
+           WHERE id = %(id)s AND status = 'pending' AND {unclaimed_sql()}
+           RETURNING id""",
+        {'status': status, 'id': report_id, 'moderator_id': moderator_id}
     )
     
+    if not cursor.fetchone():
+        return {'error': 'Report not found, already processed or claimed by another moderator'}
+    
     return {'success': True}
 
 
-def dismiss_report(cursor, report_id: int) -> dict:
-    """Отклонить жалобу"""
-    if not report_id:
-        return {'error': 'Report ID required'}
+def approve_profiles_batch(cursor, profile_ids: list, moderator_id: Optional[int] = None) -> dict:
+    """Одобрить анкеты списком и уведомить пользователей"""
+    ids = parse_id_list(profile_ids)
+    if ids is None:
+        return {'error': f'profile_ids must be a list of up to {BATCH_MAX_IDS} ids'}
     
+    # Уже решённые анкеты и анкеты в работе у другого модератора не трогаются,
+    # поэтому уведомления уходят только тем, чей статус действительно сменился
     cursor.execute(
-        "UPDATE reports SET status = 'dismissed' WHERE id = %s",
-        (report_id,)
+        f"""UPDATE profiles SET status = 'approved', updated_at = NOW()
+           WHERE id = ANY(%(ids)s) AND status = 'pending' AND {unclaimed_sql()}
+           RETURNING telegram_id""",
+        {'ids': ids, 'moderator_id': moderator_id}
     )
+    telegram_ids = [row[0] for row in cursor.fetchall()]
     
-    return {'success': True}
+    message_ids = enqueue_notifications(cursor, telegram_ids, APPROVED_MESSAGE)
+    notified = send_notifications(cursor, message_ids)
+    return {'success': True, 'updated': len(telegram_ids), 'telegram_ids': telegram_ids,
+            'queued': len(message_ids), 'notified': notified}
+
+
+def reject_profiles_batch(cursor, profile_ids: list, moderator_id: Optional[int] = None) -> dict:
+    """Отклонить анкеты списком и уведомить пользователей"""
+    ids = parse_id_list(profile_ids)
+    if ids is None:
+        return {'error': f'profile_ids must be a list of up to {BATCH_MAX_IDS} ids'}
+    
+    cursor.execute(
+        f"""UPDATE profiles SET status = 'rejected', updated_at = NOW()
+           WHERE id = ANY(%(ids)s) AND status = 'pending' AND {unclaimed_sql()}
+           RETURNING telegram_id""",
+        {'ids': ids, 'moderator_id': moderator_id}
+    )
+    telegram_ids = [row[0] for row in cursor.fetchall()]
+    
+    if telegram_ids:
+        cursor.execute("DELETE FROM browse_queue WHERE candidate_id = ANY(%s)", (telegram_ids,))
+    
+    message_ids = enqueue_notifications(cursor, telegram_ids, REJECTED_MESSAGE)
+    notified = send_notifications(cursor, message_ids)
+    return {'success': True, 'updated': len(telegram_ids), 'telegram_ids': telegram_ids,
+            'queued': len(message_ids), 'notified': notified}
+
+
+def update_reports_batch(cursor, report_ids: list, status: str, moderator_id: Optional[int] = None) -> dict:
+    """Закрыть жалобы списком с указанным статусом"""
+    ids = parse_id_list(report_ids)
+    if ids is None:
+        return {'error': f'report_ids must be a list of up to {BATCH_MAX_IDS} ids'}
+    
+    cursor.execute(
+        f"""UPDATE reports SET status = %(status)s
+           WHERE id = ANY(%(ids)s) AND status = 'pending' AND {unclaimed_sql()}
+           RETURNING id""",
+        {'status': status, 'ids': ids, 'moderator_id': moderator_id}
+    )
+    updated = [row[0] for row in cursor.fetchall()]
+    
+    return {'success': True, 'updated': len(updated), 'report_ids': updated}
+
+
+def parse_id_list(values) -> Optional[List[int]]:
+    """Проверить список id из тела запроса"""
+    if not isinstance(values, list) or not values or len(values) > BATCH_MAX_IDS:
+        return None
+    
+    try:
+        return list({int(value) for value in values})
+    except (TypeError, ValueError):
+        return None
+
+
+def enqueue_notifications(cursor, telegram_ids: List[int], text: str) -> List[int]:
+    """Поставить сообщение пользователям в исходящую очередь бота, вернуть id сообщений"""
+    if not telegram_ids:
+        return []
+    
+    cursor.execute(
+        """INSERT INTO outbox (chat_id, method, payload)
+           SELECT chat_id, 'sendMessage', jsonb_build_object('chat_id', chat_id, 'text', %s::text)
+           FROM unnest(%s::bigint[]) AS chat_id
+           RETURNING id""",
+        (text, telegram_ids)
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def send_notifications(cursor, message_ids: List[int]) -> int:
+    """Разослать свои сообщения из очереди в пределах общего бюджета, вернуть число отправленных"""
+    # Не успевшие за NOTIFY_SECONDS и не отправленные с первого раза остаются в очереди боту
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    if not bot_token or not message_ids:
+        return 0
+    
+    deadline = time.monotonic() + NOTIFY_SECONDS
+    remaining = set(message_ids)
+    sent = 0
+    
+    with ThreadPoolExecutor(max_workers=TELEGRAM_SEND_WORKERS) as executor:
+        while remaining:
+            batch, due = lease_notifications(cursor, list(remaining))
+            results = executor.map(lambda row: call_telegram(bot_token, row[1], row[2]), batch)
+            
+            delivered = []
+            for (message_id, _, _, attempts), result in zip(batch, results):
+                remaining.discard(message_id)
+                if result.get('ok'):
+                    delivered.append(message_id)
+                else:
+                    fail_notification(cursor, message_id, attempts, result)
+            
+            if delivered:
+                complete_notifications(cursor, delivered)
+            sent += len(delivered)
+            
+            # Остальные сообщения ещё не готовы: ждут очереди в своём чате
+            if due < OUTBOX_BATCH_SIZE and len(batch) == due:
+                break
+            if time.monotonic() >= deadline:
+                break
+            
+            # Общий бюджет исчерпан: ждём, пока накопится пачка токенов
+            if len(batch) < due:
+                time.sleep(min(OUTBOX_BURST, due - len(batch)) / OUTBOX_MESSAGES_PER_SECOND)
+    
+    return sent
+
+
+def lease_notifications(cursor, message_ids: List[int]) -> tuple:
+    """
+    Взять в отправку готовые сообщения из списка, списав токены общего бюджета.
+    Возвращает ([(id, method, payload, attempts)], сколько было готово).
+    """
+    # Тот же запрос, что у воркера бота, но только по своим id
+    cursor.execute(
+        f"""WITH due AS MATERIALIZED (
+               SELECT o.id, o.next_attempt_at FROM outbox o
+               WHERE o.id = ANY(%(ids)s) AND o.status = 'pending' AND o.next_attempt_at <= NOW()
+               AND NOT EXISTS (SELECT 1 FROM outbox e
+                               WHERE e.status = 'pending' AND e.chat_id = o.chat_id AND e.id < o.id)
+               ORDER BY o.next_attempt_at, o.id
+               LIMIT %(limit)s
+               FOR UPDATE SKIP LOCKED
+           ), bucket AS MATERIALIZED (
+               SELECT {OUTBOX_BUDGET_SQL} AS available FROM outbox_rate
+               WHERE EXISTS (SELECT 1 FROM due)
+               FOR UPDATE
+           ), granted AS MATERIALIZED (
+               SELECT id FROM due
+               ORDER BY next_attempt_at, id
+               LIMIT (SELECT FLOOR(available)::INTEGER FROM bucket)
+           ), spent AS (
+               UPDATE outbox_rate SET tokens = b.available - (SELECT COUNT(*) FROM granted), refilled_at = NOW()
+               FROM bucket b
+           ), picked AS (
+               UPDATE outbox SET attempts = attempts + 1, next_attempt_at = NOW() + %(lease)s
+               WHERE id IN (SELECT id FROM granted)
+               RETURNING id, method, payload, attempts
+           )
+           SELECT (SELECT COUNT(*) FROM due), p.id, p.method, p.payload, p.attempts
+           FROM (SELECT 1) one LEFT JOIN picked p ON TRUE""",
+        {
+            'ids': message_ids,
+            'lease': OUTBOX_LEASE,
+            'limit': OUTBOX_BATCH_SIZE,
+            'burst': OUTBOX_BURST,
+            'rate': OUTBOX_MESSAGES_PER_SECOND
+        }
+    )
+    rows = cursor.fetchall()
+    if not rows:
+        return [], 0
+    return [row[1:] for row in rows if row[1] is not None], rows[0][0]
+
+
+def complete_notifications(cursor, message_ids: List[int]):
+    """Удалить отправленные сообщения и сдвинуть следующие в тех же чатах"""
+    cursor.execute(
+        """WITH sent AS (
+               DELETE FROM outbox WHERE id = ANY(%(ids)s) RETURNING chat_id
+           )
+           UPDATE outbox SET next_attempt_at = GREATEST(next_attempt_at, NOW() + %(interval)s)
+           WHERE status = 'pending' AND chat_id IN (SELECT chat_id FROM sent) AND id <> ALL(%(ids)s)""",
+        {'ids': message_ids, 'interval': OUTBOX_CHAT_INTERVAL}
+    )
+
+
+def fail_notification(cursor, message_id: int, attempts: int, result: dict):
+    """Отложить сообщение с экспоненциальной паузой или пометить как неотправляемое"""
+    retry_after = (result.get('parameters') or {}).get('retry_after')
+    delay = retry_after or min(2 ** attempts + random.random(), OUTBOX_MAX_BACKOFF)
+    
+    # 400 и 403: чат не найден или бот заблокирован, повтор не поможет
+    failed = result.get('error_code') in (400, 403) or attempts >= OUTBOX_MAX_ATTEMPTS
+    cursor.execute(
+        """UPDATE outbox SET status = %s, next_attempt_at = NOW() + %s, last_error = %s
+           WHERE id = %s""",
+        ('failed' if failed else 'pending', timedelta(seconds=delay), result.get('description'), message_id)
+    )
+
+
+def get_telegram_session() -> requests.Session:
+    """Общая keep-alive сессия для Bot API"""
+    global _telegram_session
+    if _telegram_session is None:
+        _telegram_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=TELEGRAM_SEND_WORKERS)
+        _telegram_session.mount('https://', adapter)
+        _telegram_session.mount('http://', adapter)
+    return _telegram_session
+
+
+def call_telegram(bot_token: str, method: str, payload: dict) -> dict:
+    """Вызвать метод Bot API; повторы и 429 разбирает очередь"""
+    try:
+        response = get_telegram_session().post(
+            f"{TELEGRAM_API_URL}/bot{bot_token}/{method}",
+            json=payload,
+            timeout=TELEGRAM_TIMEOUT
+        )
+    except requests.RequestException as e:
+        return {'ok': False, 'description': str(e)}
+    
+    try:
+        return response.json()
+    except ValueError:
+        return {'ok': False, 'error_code': response.status_code}
 
 
 def cors_response(status_code: int, data: dict) -> dict:
     """HTTP ответ с CORS заголовками"""
+    return cors_json_response(status_code, json.dumps(data, ensure_ascii=False))
+
+
+def cors_json_response(status_code: int, body: str) -> dict:
+    """HTTP ответ с CORS заголовками и готовым JSON-телом"""
     return {
         'statusCode': status_code,
         'headers': {
@@ -224,5 +758,5 @@ def cors_response(status_code: int, data: dict) -> dict:
             'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
             'Access-Control-Allow-Headers': 'Content-Type'
         },
-        'body': json.dumps(data, ensure_ascii=False)
+        'body': body
     }
@@ -1,8 +1,204 @@
+import contextvars
+import hmac
+import itertools
 import json
 import os
+import random
+import signal
+import threading
+import time
+import numpy as np
 import psycopg2
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+from psycopg2 import pool as pg_pool
+from psycopg2 import extensions as pg_extensions
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, NamedTuple, Tuple
+
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+DB_HEALTHCHECK_IDLE_SECONDS = 30
+
+# Пул живёт на уровне модуля и переиспользуется тёплыми вызовами функции
+_db_pool = None
+_db_pool_key = None
+_db_pool_lock = threading.Lock()
+_db_last_used: Dict[int, float] = {}
+
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+TELEGRAM_TIMEOUT = (3.05, 10)
+TELEGRAM_POOL_SIZE = 10
+TELEGRAM_MAX_RETRIES = 2
+TELEGRAM_MAX_RETRY_AFTER = 5
+
+# Основной ответ возвращается в теле webhook-ответа, Telegram выполнит его сам
+TELEGRAM_WEBHOOK_REPLY = os.environ.get('TELEGRAM_WEBHOOK_REPLY', '1') == '1'
+
+DAILY_LIKE_LIMIT = 15
+LIKE_QUOTA_WINDOW = timedelta(hours=24)
+
+# Инструментирование: METRICS_ENABLED пишет замеры каждого апдейта,
+# пороги в мс включают запись только медленных апдейтов и запросов
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '0') == '1'
+SLOW_UPDATE_MS = float(os.environ.get('SLOW_UPDATE_MS', '0'))
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '0'))
+INSTRUMENTATION_ENABLED = METRICS_ENABLED or SLOW_UPDATE_MS > 0 or SLOW_QUERY_MS > 0
+
+_current_metrics: contextvars.ContextVar = contextvars.ContextVar('update_metrics', default=None)
+
+# Недавние update_id в памяти инстанса, полная история — в processed_updates
+RECENT_UPDATES_MAX = 10000
+PROCESSED_UPDATES_TTL = timedelta(days=1)
+PROCESSED_UPDATES_CLEANUP_RATE = 0.01
+# Обработку старше таймаута функции считаем оборванной: повтор забирает апдейт заново
+UPDATE_CLAIM_TIMEOUT = timedelta(seconds=float(os.environ.get('FUNCTION_TIMEOUT_SECONDS', '30')))
+
+_recent_updates: OrderedDict = OrderedDict()
+_recent_updates_lock = threading.Lock()
+
+# Кэш анкет инстанса; изменения с других инстансов приходят через LISTEN profile_changed
+PROFILE_CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', '10000'))
+PROFILE_CACHE_TTL = float(os.environ.get('PROFILE_CACHE_TTL', '60'))
+# Слушатель — одно из DB_POOL_MAX_SIZE соединений инстанса, пулу остаётся на одно меньше
+PROFILE_CACHE_LISTEN = (os.environ.get('PROFILE_CACHE_LISTEN', '1') == '1'
+                        and PROFILE_CACHE_SIZE > 0 and DB_POOL_MAX_SIZE > 1)
+PROFILE_LISTENER_CONNECT_TIMEOUT = 3
+PROFILE_LISTENER_RETRY_SECONDS = 60.0
+DB_POOL_CONNECTIONS = DB_POOL_MAX_SIZE - 1 if PROFILE_CACHE_LISTEN else DB_POOL_MAX_SIZE
+
+_profile_listener = None
+_profile_listener_lock = threading.Lock()
+_profile_listener_thread: Optional[threading.Thread] = None
+_profile_listener_retry_at = 0.0
+_profile_listener_start_lock = threading.Lock()
+
+BROWSE_QUEUE_BATCH = 20
+MATCHES_PAGE_SIZE = 20
+MAX_MATCH_ID = 2 ** 31 - 1
+SKIP_TTL = timedelta(days=7)
+
+MODERATION_LEASE = timedelta(minutes=5)
+
+# Исходящая очередь: Telegram допускает около 30 сообщений в секунду на бота и 1 в секунду на чат
+OUTBOX_MESSAGES_PER_SECOND = 25
+OUTBOX_BURST = 5
+OUTBOX_CHAT_INTERVAL = timedelta(seconds=1)
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_INLINE_BATCH = 10
+OUTBOX_LEASE = timedelta(seconds=60)
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_MAX_BACKOFF = 600
+OUTBOX_DRAIN_SECONDS = float(os.environ.get('OUTBOX_DRAIN_SECONDS', '20'))
+OUTBOX_WORKER_TOKEN = os.environ.get('OUTBOX_WORKER_TOKEN')
+
+OUTBOX_POLL_INTERVAL = 1.0
+
+# Polling-режим для своего сервера: один процесс, общий пул соединений и HTTP-сессия
+POLLING_TIMEOUT = 30
+POLLING_LIMIT = 100
+POLLING_WORKERS = int(os.environ.get('POLLING_WORKERS', str(max(1, DB_POOL_CONNECTIONS - 1))))
+POLLING_MAX_ATTEMPTS = 5
+POLLING_ERROR_DELAY = 1.0
+
+# Бюджет из строки outbox_rate: пополнение со скоростью OUTBOX_MESSAGES_PER_SECOND до OUTBOX_BURST
+OUTBOX_BUDGET_SQL = "LEAST(%(burst)s, tokens + GREATEST(EXTRACT(EPOCH FROM NOW() - refilled_at), 0) * %(rate)s)"
+
+# (токен бота, [(id, попытка, Future)]) — сообщения очереди, отправленные по ходу апдейта
+_outbox_sends: contextvars.ContextVar = contextvars.ContextVar('outbox_sends', default=None)
+
+# Анкета ещё не лайкнута и не пропущена за последние SKIP_TTL
+UNSEEN_PROFILE_SQL = """NOT EXISTS (SELECT 1 FROM likes l WHERE l.from_user_id = %(my_id)s AND l.to_user_id = p.telegram_id)
+                AND NOT EXISTS (SELECT 1 FROM skips s
+                                WHERE s.user_id = %(my_id)s AND s.skipped_user_id = p.telegram_id
+                                AND s.created_at > NOW() - %(skip_ttl)s)"""
+
+# Элемент модерации свободен или уже в работе у этого модератора
+UNCLAIMED_SQL = "(claimed_until IS NULL OR claimed_until < NOW() OR claimed_by = %(moderator_id)s)"
+
+STALE_MODERATION_MESSAGE = "⚠️ Уже обработано или в работе у другого модератора"
+
+# Ступени расширения ленты, когда подходящие анкеты кончились:
+# сначала снимается фильтр по городу, затем возрастное окно; пол остаётся всегда
+FEED_FILTER_LEVELS = (('city', 'age', 'gender'), ('age', 'gender'), ('gender',))
+
+ANY_PREFERENCE = ('любой', 'любые', 'все', 'any')
+
+# Ранжирование ленты: из пула случайных кандидатов в очередь попадают лучшие по скору
+RANKING_POOL_SIZE = int(os.environ.get('RANKING_POOL_SIZE', '500'))
+RANKING_WEIGHT_AGE = 1.0
+RANKING_WEIGHT_CITY = 0.8
+RANKING_WEIGHT_FRESH = 0.5
+RANKING_WEIGHT_ACTIVE = 0.7
+# Случайная добавка, чтобы лента не застывала на одних и тех же лидерах
+RANKING_WEIGHT_NOISE = 0.3
+RANKING_AGE_SCALE = 2.0
+RANKING_FRESH_DAYS = 30.0
+RANKING_ACTIVE_HOURS = 48.0
+RANKING_IDLE_HOURS = 1e6
+
+_ranking_rng = np.random.default_rng()
+
+
+class Profile(NamedTuple):
+    """Своя анкета пользователя: проверка статуса и /profile"""
+    telegram_id: int
+    name: str
+    age: int
+    city: str
+    gender: str
+    bio: Optional[str]
+    status: str
+    pref_gender: Optional[str]
+    pref_age_min: Optional[int]
+    pref_age_max: Optional[int]
+    pref_same_city: bool
+
+
+class ProfileCard(NamedTuple):
+    """Анкета в ленте"""
+    telegram_id: int
+    name: str
+    age: int
+    city: str
+    gender: str
+    bio: Optional[str]
+
+
+class PendingProfile(NamedTuple):
+    """Анкета на модерации"""
+    id: int
+    telegram_id: int
+    name: str
+    age: int
+    city: str
+    gender: str
+    bio: Optional[str]
+
+
+class MatchEntry(NamedTuple):
+    """Строка списка взаимных симпатий"""
+    id: int
+    username: Optional[str]
+    name: str
+    age: int
+
+
+def select_columns(record: type, alias: str = '') -> str:
+    """Список колонок запроса по полям записи"""
+    prefix = f'{alias}.' if alias else ''
+    return ', '.join(prefix + field for field in record._fields)
+
+
+# Каждый запрос читает только поля своей записи, без photo_url и отметок времени
+PROFILE_COLUMNS = select_columns(Profile)
+PROFILE_CARD_COLUMNS = select_columns(ProfileCard, 'p')
+PENDING_PROFILE_COLUMNS = select_columns(PendingProfile)
+
+_telegram_clients: Dict[str, 'TelegramClient'] = {}
+_telegram_executor: Optional[ThreadPoolExecutor] = None
 
 def handler(event: dict, context) -> dict:
     """
@@ -22,6 +218,10 @@ def handler(event: dict, context) -> dict:
             'body': ''
         }
     
+    # Вызов по таймеру разгребает исходящую очередь
+    if (event.get('queryStringParameters') or {}).get('action') == 'drain_outbox':
+        return run_outbox_worker(event)
+    
     if method != 'POST':
         return {
             'statusCode': 405,
@@ -39,14 +239,7 @@ def handler(event: dict, context) -> dict:
         if not bot_token or not db_url:
             return error_response('Missing configuration')
         
-        conn = psycopg2.connect(db_url, options=f'-c search_path={schema}')
-        conn.autocommit = True
-        cursor = conn.cursor()
-        
-        response = process_update(update, bot_token, cursor, schema)
-        
-        cursor.close()
-        conn.close()
+        response = run_update(update, bot_token, db_url, schema)
         
         return {
             'statusCode': 200,
@@ -58,13 +251,452 @@ def handler(event: dict, context) -> dict:
         return error_response(str(e))
 
 
-def process_update(update: dict, bot_token: str, cursor, schema: str) -> dict:
+def run_update(update: dict, bot_token: str, db_url: str, schema: str, polling: bool = False) -> dict:
+    """Обработать апдейт на соединении из пула, записав замеры"""
+    metrics = UpdateMetrics(update.get('update_id')) if INSTRUMENTATION_ENABLED else None
+    metrics_token = _current_metrics.set(metrics) if metrics else None
+    
+    sync_profile_cache()
+    # Слушатель открывается в фоне и не задерживает ни холодный старт, ни ответ
+    start_profile_listener(db_url)
+    
+    response = None
+    try:
+        with pooled_cursor(db_url, schema, InstrumentedCursor if metrics else None) as cursor:
+            response = process_update(update, bot_token, cursor, schema, polling)
+    finally:
+        if metrics:
+            metrics.emit(response)
+            _current_metrics.reset(metrics_token)
+    
+    return response
+
+
+class UpdateMetrics:
+    """Замеры одного апдейта: время и число запросов к БД, вызовы Bot API по методам"""
+    
+    def __init__(self, update_id: Optional[int]):
+        self.update_id = update_id
+        self.branch = None
+        self.started = time.perf_counter()
+        self.db_ms = 0.0
+        self.db_queries = 0
+        self.http: Dict[str, List[float]] = {}
+        self.lock = threading.Lock()
+    
+    def record_query(self, query: str, elapsed_ms: float):
+        self.db_ms += elapsed_ms
+        self.db_queries += 1
+        
+        if SLOW_QUERY_MS and elapsed_ms >= SLOW_QUERY_MS:
+            log_event('slow_query', update_id=self.update_id, branch=self.branch,
+                      ms=round(elapsed_ms, 2), query=' '.join(str(query).split())[:300])
+    
+    def record_http(self, method: str, elapsed_ms: float):
+        # Вызовы приходят и из потоков пула
+        with self.lock:
+            calls = self.http.setdefault(method, [0, 0.0])
+            calls[0] += 1
+            calls[1] += elapsed_ms
+    
+    def emit(self, response: Optional[dict]):
+        total_ms = (time.perf_counter() - self.started) * 1000
+        if not METRICS_ENABLED and not (SLOW_UPDATE_MS and total_ms >= SLOW_UPDATE_MS):
+            return
+        
+        log_event(
+            'update' if METRICS_ENABLED else 'slow_update',
+            update_id=self.update_id,
+            branch=self.branch,
+            ms=round(total_ms, 2),
+            db_ms=round(self.db_ms, 2),
+            db_queries=self.db_queries,
+            http={method: {'calls': calls, 'ms': round(ms, 2)} for method, (calls, ms) in self.http.items()},
+            reply=response.get('method') if response else None,
+            failed=response is None,
+            profile_cache=_profile_cache.stats()
+        )
+
+
+class InstrumentedCursor(pg_extensions.cursor):
+    """Курсор, отдающий время каждого запроса в замеры текущего апдейта"""
+    
+    def execute(self, query, vars=None):
+        metrics = _current_metrics.get()
+        if metrics is None:
+            return super().execute(query, vars)
+        
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            metrics.record_query(query, (time.perf_counter() - started) * 1000)
+
+
+class ProfileCache:
+    """LRU анкет по telegram_id с ограниченным временем жизни записи"""
+    
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def get(self, telegram_id: int) -> tuple:
+        """Вернуть (найдено, анкета); отсутствие анкеты тоже кэшируется"""
+        with self.lock:
+            entry = self.entries.get(telegram_id)
+            if entry is not None and entry[0] > time.monotonic():
+                self.entries.move_to_end(telegram_id)
+                self.hits += 1
+                return True, entry[1]
+            
+            self.misses += 1
+            return False, None
+    
+    def put(self, telegram_id: int, profile: Optional[tuple]):
+        with self.lock:
+            self.entries[telegram_id] = (time.monotonic() + self.ttl, profile)
+            self.entries.move_to_end(telegram_id)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+    
+    def invalidate(self, telegram_id: int):
+        with self.lock:
+            self.entries.pop(telegram_id, None)
+    
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+    
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else None
+            }
+
+
+_profile_cache = ProfileCache(PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+
+
+def sync_profile_cache():
+    """Сбросить из кэша анкеты, изменённые другими инстансами и moderator-api"""
+    global _profile_listener
+    if _profile_listener is None:
+        return
+    
+    # Уведомления разбирает один поток, остальные не ждут
+    if not _profile_listener_lock.acquire(blocking=False):
+        return
+    
+    try:
+        if _profile_listener is None or _profile_listener.closed:
+            _profile_cache.clear()
+            _profile_listener = None
+            return
+        
+        _profile_listener.poll()
+        while _profile_listener.notifies:
+            _profile_cache.invalidate(int(_profile_listener.notifies.pop(0).payload))
+    except psycopg2.Error as e:
+        log_event('profile_listener_failed', error=str(e))
+        _profile_cache.clear()
+        if not _profile_listener.closed:
+            _profile_listener.close()
+        _profile_listener = None
+    finally:
+        _profile_listener_lock.release()
+
+
+def start_profile_listener(db_url: str):
+    """Запустить открытие слушателя изменений анкет в фоновом потоке"""
+    global _profile_listener_thread
+    if not PROFILE_CACHE_LISTEN or _profile_listener is not None or time.monotonic() < _profile_listener_retry_at:
+        return
+    
+    with _profile_listener_start_lock:
+        if _profile_listener_thread is not None and _profile_listener_thread.is_alive():
+            return
+        
+        _profile_listener_thread = threading.Thread(
+            target=open_profile_listener, args=(db_url,), name='profile-listener', daemon=True
+        )
+        _profile_listener_thread.start()
+
+
+def open_profile_listener(db_url: str):
+    """Открыть соединение, слушающее изменения анкет; после сбоя повтор не раньше чем через паузу"""
+    global _profile_listener, _profile_listener_retry_at
+    if not _profile_listener_lock.acquire(blocking=False):
+        return
+    
+    listener = None
+    try:
+        if _profile_listener is not None:
+            return
+        
+        listener = psycopg2.connect(db_url, connect_timeout=PROFILE_LISTENER_CONNECT_TIMEOUT)
+        listener.autocommit = True
+        with listener.cursor() as cursor:
+            cursor.execute("LISTEN profile_changed")
+        
+        # Пока слушателя не было, уведомления терялись: кэш сбрасывается уже после LISTEN
+        _profile_cache.clear()
+        _profile_listener = listener
+    except psycopg2.Error as e:
+        # Без слушателя кэш живёт по TTL; новые попытки на каждом апдейте только нагружали бы базу
+        log_event('profile_listener_failed', error=str(e))
+        _profile_listener_retry_at = time.monotonic() + PROFILE_LISTENER_RETRY_SECONDS
+        if listener is not None and not listener.closed:
+            listener.close()
+    finally:
+        _profile_listener_lock.release()
+
+
+def log_event(event: str, **fields):
+    """Структурированная строка лога"""
+    print(json.dumps({'event': event, **fields}, ensure_ascii=False, default=str), flush=True)
+
+
+def get_db_pool(db_url: str, schema: str):
+    """Получить пул соединений, создав его при первом вызове"""
+    global _db_pool, _db_pool_key
+    
+    key = (db_url, schema)
+    if _db_pool is not None and not _db_pool.closed and _db_pool_key == key:
+        return _db_pool
+    
+    # Потоки polling-раннера и воркера очереди не должны создать по своему пулу
+    with _db_pool_lock:
+        if _db_pool is not None and not _db_pool.closed and _db_pool_key == key:
+            return _db_pool
+        
+        if _db_pool is not None and not _db_pool.closed:
+            _db_pool.closeall()
+        
+        _db_pool = None
+        _db_last_used.clear()
+        _db_pool = pg_pool.ThreadedConnectionPool(
+            1, DB_POOL_CONNECTIONS, db_url, options=f'-c search_path={schema}'
+        )
+        _db_pool_key = key
+        return _db_pool
+
+
+def is_connection_healthy(conn) -> bool:
+    """Проверить соединение, если оно долго простаивало в пуле"""
+    if conn.closed:
+        return False
+    
+    last_used = _db_last_used.get(id(conn))
+    if last_used is None or time.monotonic() - last_used < DB_HEALTHCHECK_IDLE_SECONDS:
+        return True
+    
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def acquire_connection(db_url: str, schema: str):
+    """Взять живое соединение из пула, переподключаясь при сбое"""
+    for attempt in range(DB_POOL_CONNECTIONS + 1):
+        try:
+            db_pool = get_db_pool(db_url, schema)
+            conn = db_pool.getconn()
+        except psycopg2.OperationalError:
+            if _db_pool is not None and not _db_pool.closed:
+                _db_pool.closeall()
+            if attempt > 0:
+                raise
+            continue
+        
+        if is_connection_healthy(conn):
+            if not conn.autocommit:
+                conn.autocommit = True
+            return conn
+        
+        _db_last_used.pop(id(conn), None)
+        db_pool.putconn(conn, close=True)
+    
+    raise psycopg2.OperationalError('No healthy database connection available')
+
+
+@contextmanager
+def pooled_cursor(db_url: str, schema: str, cursor_factory=None):
+    """Курсор на соединении из пула; сломанное соединение закрывается"""
+    conn = acquire_connection(db_url, schema)
+    broken = False
+    try:
+        with conn.cursor(cursor_factory=cursor_factory) as cursor:
+            yield cursor
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        release_connection(conn, broken)
+
+
+def release_connection(conn, broken: bool = False):
+    """Вернуть соединение в пул или закрыть сломанное"""
+    close = broken or conn.closed
+    
+    if not close and conn.get_transaction_status() != pg_extensions.TRANSACTION_STATUS_IDLE:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            close = True
+    
+    if _db_pool is None or _db_pool.closed:
+        if not conn.closed:
+            conn.close()
+        return
+    
+    if close:
+        _db_last_used.pop(id(conn), None)
+    else:
+        _db_last_used[id(conn)] = time.monotonic()
+    
+    _db_pool.putconn(conn, close=close)
+
+
+def process_update(update: dict, bot_token: str, cursor, schema: str, polling: bool = False) -> dict:
     """Обработка входящего обновления от Telegram"""
+    update_id = update.get('update_id')
+    
+    # Повтор уже принятого апдейта: Telegram ретраит медленные и упавшие вебхуки.
+    # Ответ первой обработки в теле вебхука Telegram уже отбросил, поэтому повтор
+    # его получает снова; в polling-режиме ответ был отправлен самим раннером
+    claimed, stored_response = claim_update(cursor, update_id, polling)
+    if not claimed:
+        if stored_response is None or polling:
+            return {'ok': True}
+        return stored_response
+    
+    # Уведомления, поставленные в очередь по ходу апдейта, уходят параллельно с его обработкой
+    dispatched: List[tuple] = []
+    token = _outbox_sends.set((bot_token, dispatched))
+    try:
+        # Без таймера воркера очередь разгребают сами апдейты: небольшая пачка
+        # уходит параллельно с обработкой и подводится вместе с её сообщениями
+        if not polling and not OUTBOX_WORKER_TOKEN:
+            backlog, _ = dequeue_outbox(cursor, OUTBOX_INLINE_BATCH)
+            dispatched.extend(dispatch_outbox(bot_token, backlog))
+        
+        response = route_update(update, bot_token, cursor, schema)
+    except Exception:
+        release_update(cursor, update_id)
+        raise
+    finally:
+        _outbox_sends.reset(token)
+        if dispatched:
+            try:
+                settle_outbox(cursor, dispatched)
+            except psycopg2.Error as e:
+                log_event('outbox_settle_failed', update_id=update_id, error=str(e))
+    
+    complete_update(cursor, update_id, response)
+    return response
+
+
+def claim_update(cursor, update_id: Optional[int], polling: bool = False) -> Tuple[bool, Optional[dict]]:
+    """
+    Взять апдейт в обработку.
+    Возвращает (взят ли, сохранённый ответ завершённой обработки или None).
+    """
+    if update_id is None:
+        return True, None
+    
+    with _recent_updates_lock:
+        if update_id in _recent_updates:
+            _recent_updates.move_to_end(update_id)
+            return False, _recent_updates[update_id]
+    
+    # Новый апдейт вставляется, зависший в processing забирается заново;
+    # единственный polling-раннер сам был прошлым владельцем, ждать таймаута незачем
+    cursor.execute(
+        """WITH claimed AS (
+               INSERT INTO processed_updates (update_id, state, started_at) VALUES (%(update_id)s, 'processing', NOW())
+               ON CONFLICT (update_id) DO UPDATE SET started_at = NOW()
+               WHERE processed_updates.state = 'processing' AND processed_updates.started_at < NOW() - %(timeout)s
+               RETURNING update_id
+           )
+           SELECT EXISTS (SELECT 1 FROM claimed),
+                  (SELECT response FROM processed_updates WHERE update_id = %(update_id)s AND state = 'done')""",
+        {'update_id': update_id, 'timeout': timedelta(0) if polling else UPDATE_CLAIM_TIMEOUT}
+    )
+    claimed, stored_response = cursor.fetchone()
+    
+    if stored_response is not None:
+        remember_update(update_id, stored_response)
+    
+    if claimed and random.random() < PROCESSED_UPDATES_CLEANUP_RATE:
+        cursor.execute(
+            "DELETE FROM processed_updates WHERE processed_at < NOW() - %s",
+            (PROCESSED_UPDATES_TTL,)
+        )
+    
+    return claimed, stored_response
+
+
+def complete_update(cursor, update_id: Optional[int], response: dict):
+    """Отметить апдейт обработанным и сохранить ответ для повторов"""
+    if update_id is None:
+        return
+    
+    cursor.execute(
+        """UPDATE processed_updates SET state = 'done', response = %s, processed_at = NOW()
+           WHERE update_id = %s""",
+        (json.dumps(response, ensure_ascii=False), update_id)
+    )
+    remember_update(update_id, response)
+
+
+def remember_update(update_id: int, response: dict):
+    """Запомнить ответ завершённого апдейта в памяти инстанса"""
+    # В памяти только завершённые: незавершённую обработку мог оборвать таймаут
+    with _recent_updates_lock:
+        _recent_updates[update_id] = response
+        _recent_updates.move_to_end(update_id)
+        if len(_recent_updates) > RECENT_UPDATES_MAX:
+            _recent_updates.popitem(last=False)
+
+
+def release_update(cursor, update_id: Optional[int]):
+    """Снять отметку с апдейта, обработка которого упала, чтобы повтор прошёл заново"""
+    if update_id is None:
+        return
+    
+    with _recent_updates_lock:
+        _recent_updates.pop(update_id, None)
+    
+    try:
+        cursor.execute("DELETE FROM processed_updates WHERE update_id = %s", (update_id,))
+    except psycopg2.Error:
+        pass
+
+
+def route_update(update: dict, bot_token: str, cursor, schema: str) -> dict:
+    """Передать апдейт обработчику сообщения или callback'а"""
+    metrics = _current_metrics.get()
     
     if 'message' in update:
+        if metrics:
+            text = update['message'].get('text', '')
+            metrics.branch = text.split()[0] if text.startswith('/') else 'text'
         return handle_message(update['message'], bot_token, cursor, schema)
     
     if 'callback_query' in update:
+        if metrics:
+            metrics.branch = update['callback_query'].get('data', '').rsplit('_', 1)[0]
         return handle_callback(update['callback_query'], bot_token, cursor, schema)
     
     return {'ok': True}
@@ -80,6 +712,8 @@ def handle_message(message: dict, bot_token: str, cursor, schema: str) -> dict:
     admin_id = os.environ.get('ADMIN_TELEGRAM_ID', '')
     is_admin = str(chat_id) == admin_id
     
+    command, _, argument = text.partition(' ')
+    
     if text == '/start':
         msg = "💜 Добро пожаловать в бот знакомств для подростков!\n\n"
         msg += "Здесь ты можешь найти новых друзей.\n\n"
@@ -88,6 +722,7 @@ def handle_message(message: dict, bot_token: str, cursor, schema: str) -> dict:
         msg += "/browse - Смотреть анкеты\n"
         msg += "/matches - Взаимные лайки\n"
         msg += "/profile - Моя анкета\n"
+        msg += "/prefs - Кого показывать\n"
         msg += "/help - Помощь\n"
         
         if is_admin:
@@ -96,14 +731,14 @@ def handle_message(message: dict, bot_token: str, cursor, schema: str) -> dict:
             msg += "/reports - Просмотреть жалобы\n"
             msg += "/stats - Статистика бота"
         
-        return send_message(bot_token, chat_id, msg)
+        return reply_message(bot_token, chat_id, msg)
     
     if text == '/create':
         profile = get_profile(cursor, chat_id)
         if profile:
-            return send_message(bot_token, chat_id, "У тебя уже есть анкета! Используй /profile чтобы её посмотреть.")
+            return reply_message(bot_token, chat_id, "У тебя уже есть анкета! Используй /profile чтобы её посмотреть.")
         
-        return send_message(
+        return reply_message(
             bot_token,
             chat_id,
             "Давай создадим твою анкету! 📝\n\n"
@@ -124,82 +759,90 @@ def handle_message(message: dict, bot_token: str, cursor, schema: str) -> dict:
     if text == '/browse':
         profile = get_profile(cursor, chat_id)
         if not profile:
-            return send_message(bot_token, chat_id, "Сначала создай анкету командой /create")
+            return reply_message(bot_token, chat_id, "Сначала создай анкету командой /create")
         
-        if profile[9] != 'approved':
-            return send_message(bot_token, chat_id, "Твоя анкета ещё не одобрена модератором. Подожди немного!")
+        if profile.status != 'approved':
+            return reply_message(bot_token, chat_id, "Твоя анкета ещё не одобрена модератором. Подожди немного!")
         
         likes_today = count_likes_today(cursor, chat_id)
-        if likes_today >= 15:
-            return send_message(bot_token, chat_id, "Лимит лайков исчерпан (15/15). Приходи завтра! 🌙")
+        if likes_today >= DAILY_LIKE_LIMIT:
+            return reply_message(
+                bot_token,
+                chat_id,
+                f"Лимит лайков исчерпан ({DAILY_LIKE_LIMIT}/{DAILY_LIKE_LIMIT}). Приходи завтра! 🌙"
+            )
         
-        next_profile = get_next_profile(cursor, chat_id)
+        next_profile, liked_me_waiting = get_next_profile(cursor, chat_id)
         if not next_profile:
-            return send_message(bot_token, chat_id, "Пока нет новых анкет. Загляни позже!")
+            return reply_message(bot_token, chat_id, "Пока нет новых анкет. Загляни позже!")
         
-        return show_profile_card(bot_token, chat_id, next_profile, likes_today)
+        return show_profile_card(bot_token, chat_id, next_profile, likes_today, liked_me_waiting=liked_me_waiting)
     
     if text == '/matches':
         profile = get_profile(cursor, chat_id)
         if not profile:
-            return send_message(bot_token, chat_id, "Сначала создай анкету командой /create")
-        
-        matches = get_matches(cursor, chat_id)
-        if not matches:
-            return send_message(bot_token, chat_id, "Пока нет взаимных лайков 💔\n\nПродолжай смотреть анкеты!")
-        
-        text = "💜 Взаимные симпатии:\n\n"
-        for match in matches:
-            text += f"👤 {match[3]}, {match[4]} — @{match[2] or 'нет username'}\n"
+            return reply_message(bot_token, chat_id, "Сначала создай анкету командой /create")
         
-        return send_message(bot_token, chat_id, text)
+        return show_matches(bot_token, chat_id, cursor)
     
     if text == '/profile':
         profile = get_profile(cursor, chat_id)
         if not profile:
-            return send_message(bot_token, chat_id, "У тебя ещё нет анкеты. Создай её командой /create")
+            return reply_message(bot_token, chat_id, "У тебя ещё нет анкеты. Создай её командой /create")
         
         status_emoji = {'pending': '⏳', 'approved': '✅', 'rejected': '❌'}
         status_text = {'pending': 'На модерации', 'approved': 'Одобрено', 'rejected': 'Отклонено'}
         
         text = (
             f"📋 Твоя анкета:\n\n"
-            f"Имя: {profile[3]}\n"
-            f"Возраст: {profile[4]}\n"
-            f"Город: {profile[5]}\n"
-            f"Пол: {'Парень' if profile[6] == 'male' else 'Девушка'}\n"
+            f"Имя: {profile.name}\n"
+            f"Возраст: {profile.age}\n"
+            f"Город: {profile.city}\n"
+            f"Пол: {'Парень' if profile.gender == 'male' else 'Девушка'}\n"
         )
         
-        if profile[8]:
-            text += f"О себе: {profile[8]}\n"
+        if profile.bio:
+            text += f"О себе: {profile.bio}\n"
         
-        text += f"\nСтатус: {status_emoji[profile[9]]} {status_text[profile[9]]}"
+        text += f"\nСтатус: {status_emoji[profile.status]} {status_text[profile.status]}"
         
-        return send_message(bot_token, chat_id, text)
+        return reply_message(bot_token, chat_id, text)
+    
+    if text == '/prefs':
+        profile = get_profile(cursor, chat_id)
+        if not profile:
+            return reply_message(bot_token, chat_id, "Сначала создай анкету командой /create")
+        
+        return reply_message(bot_token, chat_id, format_preferences(profile))
+    
+    if command in ('/gender', '/age', '/city'):
+        return update_preferences(bot_token, chat_id, cursor, command, argument)
     
     if text == '/moderate':
         if not is_admin:
-            return send_message(bot_token, chat_id, "У вас нет доступа к этой команде")
+            return reply_message(bot_token, chat_id, "У вас нет доступа к этой команде")
         return show_pending_profiles(bot_token, chat_id, cursor)
     
     if text == '/reports':
         if not is_admin:
-            return send_message(bot_token, chat_id, "У вас нет доступа к этой команде")
+            return reply_message(bot_token, chat_id, "У вас нет доступа к этой команде")
         return show_reports(bot_token, chat_id, cursor)
     
     if text == '/stats':
         if not is_admin:
-            return send_message(bot_token, chat_id, "У вас нет доступа к этой команде")
+            return reply_message(bot_token, chat_id, "У вас нет доступа к этой команде")
         return show_stats(bot_token, chat_id, cursor)
     
     if text == '/help':
-        return send_message(
+        return reply_message(
             bot_token,
             chat_id,
             "ℹ️ Помощь:\n\n"
             "🔹 Создай анкету командой /create\n"
             "🔹 Просматривай анкеты - /browse\n"
-            "🔹 Ставь лайки (15 в день)\n"
+            "🔹 Выбери, кого показывать - /prefs\n"
+            "🔹 Те, кто уже лайкнул тебя, показываются первыми\n"
+            f"🔹 Ставь лайки ({DAILY_LIKE_LIMIT} в день)\n"
             "🔹 При взаимном лайке откроется username\n"
             "🔹 Все анкеты проверяет модератор\n\n"
             "⚠️ Правила:\n"
@@ -215,7 +858,84 @@ def handle_message(message: dict, bot_token: str, cursor, schema: str) -> dict:
         if not profile:
             return create_profile_from_text(bot_token, chat_id, user, lines, cursor)
     
-    return send_message(bot_token, chat_id, "Используй команды: /start, /create, /browse, /matches, /profile, /help")
+    return reply_message(bot_token, chat_id, "Используй команды: /start, /create, /browse, /matches, /profile, /prefs, /help")
+
+
+def format_preferences(profile: Profile) -> str:
+    """Текущие предпочтения ленты и команды для их изменения"""
+    gender_text = {'male': 'парни', 'female': 'девушки'}.get(profile.pref_gender, 'любой')
+    age_text = f"{profile.pref_age_min}–{profile.pref_age_max}" if profile.pref_age_min is not None else 'любой'
+    city_text = f"только {profile.city}" if profile.pref_same_city else 'любой'
+    
+    return (
+        f"⚙️ Кого показывать в ленте:\n\n"
+        f"Пол: {gender_text}\n"
+        f"Возраст: {age_text}\n"
+        f"Город: {city_text}\n\n"
+        "Изменить:\n"
+        "/gender М, Ж или любой\n"
+        "/age 15 17 или любой\n"
+        "/city да — только мой город, нет — любой\n\n"
+        "Если подходящие анкеты закончатся, покажем похожие"
+    )
+
+
+def parse_preference(command: str, argument: str) -> Optional[dict]:
+    """Разобрать аргумент команды предпочтений; None, если он неверный"""
+    value = argument.strip().lower()
+    
+    if command == '/gender':
+        if value in ANY_PREFERENCE:
+            return {'pref_gender': None}
+        if value in ('м', 'm', 'парни', 'парень'):
+            return {'pref_gender': 'male'}
+        if value in ('ж', 'f', 'девушки', 'девушка'):
+            return {'pref_gender': 'female'}
+        return None
+    
+    if command == '/age':
+        if value in ANY_PREFERENCE:
+            return {'pref_age_min': None, 'pref_age_max': None}
+        try:
+            ages = [int(part) for part in value.replace('-', ' ').split()]
+        except ValueError:
+            return None
+        if len(ages) not in (1, 2) or not 13 <= min(ages) <= max(ages) <= 19:
+            return None
+        return {'pref_age_min': min(ages), 'pref_age_max': max(ages)}
+    
+    if value in ('да', 'yes', 'on'):
+        return {'pref_same_city': True}
+    if value in ('нет', 'no', 'off'):
+        return {'pref_same_city': False}
+    return None
+
+
+def update_preferences(bot_token: str, chat_id: int, cursor, command: str, argument: str) -> dict:
+    """Изменить предпочтения ленты командами /gender, /age и /city"""
+    profile = get_profile(cursor, chat_id)
+    if not profile:
+        return reply_message(bot_token, chat_id, "Сначала создай анкету командой /create")
+    
+    changes = parse_preference(command, argument)
+    if changes is None:
+        return reply_message(bot_token, chat_id, "Не понял 🤔\n\n" + format_preferences(profile))
+    
+    # Очередь собрана по старым предпочтениям, новые применяются со следующей анкеты
+    assignments = ', '.join(f"{column} = %({column})s" for column in changes)
+    cursor.execute(
+        f"""WITH cleared AS (
+               DELETE FROM browse_queue WHERE user_id = %(chat_id)s
+           )
+           UPDATE profiles SET {assignments}, updated_at = NOW()
+           WHERE telegram_id = %(chat_id)s
+           RETURNING {PROFILE_COLUMNS}""",
+        {**changes, 'chat_id': chat_id}
+    )
+    profile = Profile._make(cursor.fetchone())
+    _profile_cache.put(chat_id, profile)
+    
+    return reply_message(bot_token, chat_id, "✅ Сохранено\n\n" + format_preferences(profile))
 
 
 def handle_callback(callback: dict, bot_token: str, cursor, schema: str) -> dict:
@@ -227,10 +947,15 @@ def handle_callback(callback: dict, bot_token: str, cursor, schema: str) -> dict
     
     if data.startswith('like_'):
         target_id = int(data.split('_')[1])
-        return handle_like(bot_token, chat_id, target_id, cursor, message_id)
+        return handle_like(bot_token, chat_id, target_id, cursor, message_id, callback['id'])
     
     if data.startswith('skip_'):
-        return handle_skip(bot_token, chat_id, message_id)
+        target_id = int(data.split('_')[1])
+        return handle_skip(bot_token, chat_id, target_id, cursor, message_id)
+    
+    if data.startswith('matches_'):
+        before_id = int(data.split('_')[1])
+        return show_matches(bot_token, chat_id, cursor, before_id)
     
     if data.startswith('report_'):
         target_id = int(data.split('_')[1])
@@ -255,82 +980,63 @@ def handle_callback(callback: dict, bot_token: str, cursor, schema: str) -> dict
     return {'ok': True}
 
 
-def handle_like(bot_token: str, chat_id: int, target_id: int, cursor, message_id: int) -> dict:
+def handle_like(bot_token: str, chat_id: int, target_id: int, cursor, message_id: int, callback_id: str) -> dict:
     """Обработка лайка"""
     
-    likes_today = count_likes_today(cursor, chat_id)
-    if likes_today >= 15:
-        answer_callback(bot_token, chat_id, "Лимит лайков исчерпан (15/15)")
+    likes_used, already_liked, is_mutual, target_name, target_username = register_like(cursor, chat_id, target_id)
+    if likes_used is None:
+        answer_callback(bot_token, callback_id, f"Лимит лайков исчерпан ({DAILY_LIKE_LIMIT}/{DAILY_LIKE_LIMIT})")
         return {'ok': True}
     
-    cursor.execute(
-        "INSERT INTO likes (from_user_id, to_user_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-        (chat_id, target_id)
-    )
-    
-    cursor.execute(
-        "SELECT 1 FROM likes WHERE from_user_id = %s AND to_user_id = %s",
-        (target_id, chat_id)
-    )
-    
-    is_mutual = cursor.fetchone() is not None
+    pending = [dispatch_api(bot_token, 'deleteMessage', {'chat_id': chat_id, 'message_id': message_id})]
     
     if is_mutual:
-        cursor.execute(
-            "INSERT INTO matches (user1_id, user2_id) VALUES (%s, %s) ON CONFLICT DO NOTHING",
-            (min(chat_id, target_id), max(chat_id, target_id))
-        )
-        
-        cursor.execute(
-            "SELECT name, username FROM profiles WHERE telegram_id = %s",
-            (target_id,)
-        )
-        target = cursor.fetchone()
-        
-        send_message(
+        pending.append(dispatch_message(
             bot_token,
             chat_id,
-            f"💜 Взаимная симпатия!\n\nВы можете написать: @{target[1] or 'нет username'}"
-        )
-        
-        send_message(
-            bot_token,
-            target_id,
-            f"💜 Взаимная симпатия!\n\nВы можете написать: @{chat_id}"
-        )
-    else:
-        send_message(bot_token, chat_id, "❤️ Лайк отправлен!")
-    
-    delete_message(bot_token, chat_id, message_id)
+            f"💜 Взаимная симпатия!\n\nВы можете написать: @{target_username or 'нет username'}"
+        ))
+        enqueue_message(cursor, target_id, f"💜 Взаимная симпатия!\n\nВы можете написать: @{chat_id}")
+    elif not already_liked:
+        pending.append(dispatch_message(bot_token, chat_id, "❤️ Лайк отправлен!"))
     
-    next_profile = get_next_profile(cursor, chat_id)
+    next_profile, liked_me_waiting = get_next_profile(cursor, chat_id)
     if next_profile:
-        show_profile_card(bot_token, chat_id, next_profile, likes_today + 1)
-    else:
-        send_message(bot_token, chat_id, "Пока нет новых анкет. Загляни позже!")
+        return show_profile_card(bot_token, chat_id, next_profile, likes_used, pending, liked_me_waiting)
     
-    return {'ok': True}
+    return reply_message(bot_token, chat_id, "Пока нет новых анкет. Загляни позже!", wait_for=pending)
 
 
-def handle_skip(bot_token: str, chat_id: int, message_id: int) -> dict:
+def handle_skip(bot_token: str, chat_id: int, target_id: int, cursor, message_id: int) -> dict:
     """Пропуск анкеты"""
-    delete_message(bot_token, chat_id, message_id)
-    send_message(bot_token, chat_id, "Используй /browse чтобы смотреть анкеты дальше")
-    return {'ok': True}
+    pending = [dispatch_api(bot_token, 'deleteMessage', {'chat_id': chat_id, 'message_id': message_id})]
+    
+    cursor.execute(
+        """INSERT INTO skips (user_id, skipped_user_id) VALUES (%s, %s)
+           ON CONFLICT (user_id, skipped_user_id) DO UPDATE SET created_at = NOW()""",
+        (chat_id, target_id)
+    )
+    
+    likes_today = count_likes_today(cursor, chat_id)
+    next_profile, liked_me_waiting = get_next_profile(cursor, chat_id)
+    if next_profile:
+        return show_profile_card(bot_token, chat_id, next_profile, likes_today, pending, liked_me_waiting)
+    
+    return reply_message(bot_token, chat_id, "Пока нет новых анкет. Загляни позже!", wait_for=pending)
 
 
 def handle_report(bot_token: str, chat_id: int, target_id: int, cursor, message_id: int) -> dict:
     """Жалоба на пользователя"""
     
     cursor.execute(
-        "INSERT INTO reports (reporter_id, reported_user_id, reason) VALUES (%s, %s, %s)",
+        """INSERT INTO reports (reporter_id, reported_user_id, reason) VALUES (%s, %s, %s)
+           ON CONFLICT (reporter_id, reported_user_id) WHERE status = 'pending' DO NOTHING""",
         (chat_id, target_id, 'Жалоба через бота')
     )
     
-    send_message(bot_token, chat_id, "Жалоба отправлена модератору. Спасибо!")
     delete_message(bot_token, chat_id, message_id)
     
-    return {'ok': True}
+    return reply_message(bot_token, chat_id, "Жалоба отправлена модератору. Спасибо!")
 
 
 def create_profile_from_text(bot_token: str, chat_id: int, user: dict, lines: list, cursor) -> dict:
@@ -344,7 +1050,7 @@ def create_profile_from_text(bot_token: str, chat_id: int, user: dict, lines: li
         bio = lines[4].strip() if len(lines) > 4 else ''
         
         if age < 13 or age > 19:
-            return send_message(bot_token, chat_id, "Возраст должен быть от 13 до 19 лет")
+            return reply_message(bot_token, chat_id, "Возраст должен быть от 13 до 19 лет")
         
         username = user.get('username', '')
         
@@ -353,8 +1059,9 @@ def create_profile_from_text(bot_token: str, chat_id: int, user: dict, lines: li
                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
             (chat_id, username, name, age, city, gender, 'https://via.placeholder.com/400', bio, 'pending')
         )
+        _profile_cache.invalidate(chat_id)
         
-        return send_message(
+        return reply_message(
             bot_token,
             chat_id,
             "✅ Анкета создана и отправлена на модерацию!\n\n"
@@ -363,174 +1070,736 @@ def create_profile_from_text(bot_token: str, chat_id: int, user: dict, lines: li
         )
         
     except (ValueError, IndexError):
-        return send_message(bot_token, chat_id, "Неверный формат. Попробуй ещё раз командой /create")
+        return reply_message(bot_token, chat_id, "Неверный формат. Попробуй ещё раз командой /create")
 
 
-def get_profile(cursor, telegram_id: int) -> Optional[tuple]:
+def get_profile(cursor, telegram_id: int) -> Optional[Profile]:
     """Получить профиль пользователя"""
-    cursor.execute("SELECT * FROM profiles WHERE telegram_id = %s", (telegram_id,))
-    return cursor.fetchone()
+    found, profile = _profile_cache.get(telegram_id)
+    if found:
+        return profile
+    
+    cursor.execute(f"SELECT {PROFILE_COLUMNS} FROM profiles WHERE telegram_id = %s", (telegram_id,))
+    row = cursor.fetchone()
+    profile = Profile._make(row) if row else None
+    _profile_cache.put(telegram_id, profile)
+    return profile
+
+
+def get_next_profile(cursor, my_id: int) -> Tuple[Optional[ProfileCard], int]:
+    """
+    Получить следующую анкету: сначала тех, кто уже лайкнул и ждёт ответа, затем из очереди просмотра.
+    Возвращает (анкета, сколько лайков ждёт ответа, если анкета из них, иначе 0).
+    """
+    # Ответный лайк сразу даёт совпадение, поэтому такие анкеты идут вне очереди
+    liker, waiting = pop_liked_me(cursor, my_id)
+    if liker is not None:
+        return liker, waiting
+    
+    profile = pop_browse_queue(cursor, my_id)
+    if profile is None and refill_browse_queue(cursor, my_id):
+        profile = pop_browse_queue(cursor, my_id)
+    return profile, 0
 
 
-def get_next_profile(cursor, my_id: int) -> Optional[tuple]:
-    """Получить следующую анкету для просмотра"""
+def pop_liked_me(cursor, my_id: int) -> Tuple[Optional[ProfileCard], int]:
+    """Самая свежая одобренная анкета, лайкнувшая пользователя, на которую он ещё не ответил"""
+    # Входящие лайки по idx_likes_to_user_from; пол — единственный фильтр предпочтений,
+    # который не ослабляется и здесь
+    viewer = get_profile(cursor, my_id)
+    gender_filter = feed_filter_sql(viewer, ('gender',))
     cursor.execute(
-        """SELECT * FROM profiles 
-           WHERE telegram_id != %s 
-           AND status = 'approved'
-           AND telegram_id NOT IN (SELECT to_user_id FROM likes WHERE from_user_id = %s)
-           ORDER BY RANDOM()
+        f"""SELECT {PROFILE_CARD_COLUMNS}, COUNT(*) OVER () AS waiting
+           FROM likes lm
+           JOIN profiles p ON p.telegram_id = lm.from_user_id
+           WHERE lm.to_user_id = %(my_id)s
+           AND p.status = 'approved'{gender_filter}
+           AND {UNSEEN_PROFILE_SQL}
+           ORDER BY lm.id DESC
            LIMIT 1""",
-        (my_id, my_id)
+        {'my_id': my_id, 'skip_ttl': SKIP_TTL, 'gender': viewer.pref_gender if viewer else None}
     )
-    return cursor.fetchone()
+    row = cursor.fetchone()
+    if row is None:
+        return None, 0
+    return ProfileCard._make(row[:-1]), row[-1]
+
+
+def pop_browse_queue(cursor, my_id: int) -> Optional[ProfileCard]:
+    """Снять из очереди первую актуальную анкету вместе с устаревшими перед ней"""
+    # Анкета могла быть показана из входящих лайков и пропущена уже после пополнения очереди
+    cursor.execute(
+        f"""WITH head AS (
+               SELECT q.id, q.candidate_id FROM browse_queue q
+               JOIN profiles p ON p.telegram_id = q.candidate_id
+               WHERE q.user_id = %(my_id)s
+               AND p.status = 'approved'
+               AND {UNSEEN_PROFILE_SQL}
+               ORDER BY q.id
+               LIMIT 1
+           ), popped AS (
+               DELETE FROM browse_queue
+               WHERE user_id = %(my_id)s AND id <= (SELECT id FROM head)
+           )
+           SELECT {PROFILE_CARD_COLUMNS} FROM head JOIN profiles p ON p.telegram_id = head.candidate_id""",
+        {'my_id': my_id, 'skip_ttl': SKIP_TTL}
+    )
+    row = cursor.fetchone()
+    return ProfileCard._make(row) if row else None
+
+
+def refill_browse_queue(cursor, my_id: int) -> int:
+    """Заполнить очередь пачкой новых анкет, вернуть их количество"""
+    viewer = get_profile(cursor, my_id)
+    
+    # Пока по предпочтениям ничего не нашлось, фильтр постепенно расширяется
+    tried = set()
+    for filters in FEED_FILTER_LEVELS:
+        filter_sql = feed_filter_sql(viewer, filters)
+        if filter_sql in tried:
+            continue
+        tried.add(filter_sql)
+        
+        added = insert_browse_batch(cursor, my_id, viewer, filter_sql)
+        if added:
+            return added
+    
+    return 0
+
+
+def feed_filter_sql(viewer: Optional[Profile], filters: tuple) -> str:
+    """Условия ленты по предпочтениям зрителя для выбранной ступени"""
+    if viewer is None:
+        return ''
+    
+    conditions = []
+    if 'city' in filters and viewer.pref_same_city:
+        conditions.append("p.city_norm = normalize_city(%(city)s)")
+    if 'age' in filters and viewer.pref_age_min is not None:
+        conditions.append("p.age BETWEEN %(age_min)s AND %(age_max)s")
+    if 'gender' in filters and viewer.pref_gender:
+        conditions.append("p.gender = %(gender)s")
+    
+    return ''.join(f"\n                AND {condition}" for condition in conditions)
+
+
+def insert_browse_batch(cursor, my_id: int, viewer: Optional[Profile], filter_sql: str) -> int:
+    """Положить в очередь лучшие по скору непросмотренные анкеты, подходящие под фильтр"""
+    candidates = fetch_candidates(cursor, my_id, viewer, filter_sql)
+    if not candidates:
+        return 0
+    
+    ranked = rank_candidates(candidates, viewer.age if viewer else None, BROWSE_QUEUE_BATCH)
+    
+    # Порядок id в очереди — порядок показа
+    cursor.execute(
+        """WITH cleared AS (
+               DELETE FROM browse_queue WHERE user_id = %(my_id)s
+           ), expired AS (
+               DELETE FROM skips WHERE user_id = %(my_id)s AND created_at <= NOW() - %(skip_ttl)s
+           )
+           INSERT INTO browse_queue (user_id, candidate_id)
+           SELECT %(my_id)s, c.candidate_id
+           FROM unnest(%(ranked)s::bigint[]) WITH ORDINALITY AS c(candidate_id, position)
+           ORDER BY c.position""",
+        {'my_id': my_id, 'skip_ttl': SKIP_TTL, 'ranked': ranked}
+    )
+    return cursor.rowcount
 
 
-def get_matches(cursor, my_id: int) -> list:
-    """Получить список взаимных лайков"""
+def fetch_candidates(cursor, my_id: int, viewer: Optional[Profile], filter_sql: str) -> List[tuple]:
+    """Пул непросмотренных анкет с признаками для ранжирования"""
+    # Случайная точка на индексе random_key вместо сортировки всех анкет;
+    # вторая ветка замыкает круг, если после точки анкет не хватило
+    pivot = random.random()
     cursor.execute(
-        """SELECT p.* FROM profiles p
-           INNER JOIN matches m ON (p.telegram_id = m.user1_id OR p.telegram_id = m.user2_id)
-           WHERE (m.user1_id = %s OR m.user2_id = %s) AND p.telegram_id != %s""",
-        (my_id, my_id, my_id)
+        f"""SELECT p.telegram_id,
+                  p.age,
+                  COALESCE(p.city_norm = normalize_city(%(city)s), FALSE)::INTEGER,
+                  COALESCE(EXTRACT(EPOCH FROM NOW() - p.created_at)::FLOAT8 / 86400, %(idle)s),
+                  COALESCE(EXTRACT(EPOCH FROM NOW() - q.window_start)::FLOAT8 / 3600, %(idle)s)
+           FROM (
+               (SELECT p.telegram_id FROM profiles p
+                WHERE p.status = 'approved'
+                AND p.random_key >= %(pivot)s
+                AND p.telegram_id != %(my_id)s{filter_sql}
+                AND {UNSEEN_PROFILE_SQL}
+                ORDER BY p.random_key
+                LIMIT %(pool)s)
+               UNION ALL
+               (SELECT p.telegram_id FROM profiles p
+                WHERE p.status = 'approved'
+                AND p.random_key < %(pivot)s
+                AND p.telegram_id != %(my_id)s{filter_sql}
+                AND {UNSEEN_PROFILE_SQL}
+                ORDER BY p.random_key
+                LIMIT %(pool)s)
+               LIMIT %(pool)s
+           ) c
+           JOIN profiles p ON p.telegram_id = c.telegram_id
+           LEFT JOIN like_quota q ON q.user_id = p.telegram_id""",
+        {
+            'pivot': pivot,
+            'my_id': my_id,
+            'pool': RANKING_POOL_SIZE,
+            'skip_ttl': SKIP_TTL,
+            'idle': RANKING_IDLE_HOURS,
+            'city': viewer.city if viewer else None,
+            'age_min': viewer.pref_age_min if viewer else None,
+            'age_max': viewer.pref_age_max if viewer else None,
+            'gender': viewer.pref_gender if viewer else None
+        }
     )
     return cursor.fetchall()
 
 
+def rank_candidates(candidates: List[tuple], viewer_age: Optional[int], limit: int) -> List[int]:
+    """
+    Оценить кандидатов одним векторным проходом и вернуть limit лучших id по убыванию скора.
+    Строка кандидата: (telegram_id, возраст, тот же город, дней с создания анкеты,
+    часов с последней активности). Лайкнувших зрителя здесь нет: их отдаёт pop_liked_me.
+    """
+    # fromiter по плоской последовательности вдвое быстрее np.array по списку кортежей
+    width = len(candidates[0])
+    features = np.fromiter(
+        itertools.chain.from_iterable(candidates), dtype=np.float64, count=len(candidates) * width
+    ).reshape(-1, width)
+    
+    age_diff = np.abs(features[:, 1] - viewer_age) if viewer_age is not None else 0.0
+    scores = (
+        RANKING_WEIGHT_AGE * np.exp(-age_diff / RANKING_AGE_SCALE)
+        + RANKING_WEIGHT_CITY * features[:, 2]
+        + RANKING_WEIGHT_FRESH * np.exp(-features[:, 3] / RANKING_FRESH_DAYS)
+        + RANKING_WEIGHT_ACTIVE * np.exp(-features[:, 4] / RANKING_ACTIVE_HOURS)
+        + RANKING_WEIGHT_NOISE * _ranking_rng.random(len(features))
+    )
+    
+    # Полная сортировка не нужна: сначала отбор limit лучших, потом их порядок
+    if len(scores) > limit:
+        top = np.argpartition(-scores, limit)[:limit]
+    else:
+        top = np.arange(len(scores))
+    top = top[np.argsort(-scores[top])]
+    
+    return features[top, 0].astype(np.int64).tolist()
+
+
+def invalidate_browse_queue(cursor, telegram_id: int):
+    """Убрать анкету из очередей просмотра всех пользователей"""
+    cursor.execute("DELETE FROM browse_queue WHERE candidate_id = %s", (telegram_id,))
+
+
+def get_matches(cursor, my_id: int, before_id: Optional[int] = None) -> List[MatchEntry]:
+    """Получить страницу взаимных лайков, от новых к старым"""
+    # Две ветки вместо OR, чтобы каждая шла по своему индексу;
+    # берём на одну запись больше, чтобы понять, есть ли следующая страница
+    cursor.execute(
+        """SELECT m.id, p.username, p.name, p.age FROM (
+               (SELECT id, user2_id AS other_id FROM matches
+                WHERE user1_id = %(my_id)s AND id < %(before_id)s
+                ORDER BY id DESC
+                LIMIT %(limit)s)
+               UNION ALL
+               (SELECT id, user1_id AS other_id FROM matches
+                WHERE user2_id = %(my_id)s AND id < %(before_id)s
+                ORDER BY id DESC
+                LIMIT %(limit)s)
+           ) m
+           JOIN profiles p ON p.telegram_id = m.other_id
+           ORDER BY m.id DESC
+           LIMIT %(limit)s""",
+        {
+            'my_id': my_id,
+            'before_id': before_id if before_id is not None else MAX_MATCH_ID,
+            'limit': MATCHES_PAGE_SIZE + 1
+        }
+    )
+    return [MatchEntry._make(row) for row in cursor.fetchall()]
+
+
+def show_matches(bot_token: str, chat_id: int, cursor, before_id: Optional[int] = None) -> dict:
+    """Показать страницу взаимных лайков с кнопкой продолжения"""
+    matches = get_matches(cursor, chat_id, before_id)
+    if not matches:
+        if before_id is None:
+            return reply_message(bot_token, chat_id, "Пока нет взаимных лайков 💔\n\nПродолжай смотреть анкеты!")
+        return reply_message(bot_token, chat_id, "Это все взаимные симпатии 💜")
+    
+    has_more = len(matches) > MATCHES_PAGE_SIZE
+    matches = matches[:MATCHES_PAGE_SIZE]
+    
+    lines = ["💜 Взаимные симпатии:", ""]
+    lines.extend(f"👤 {match.name}, {match.age} — @{match.username or 'нет username'}" for match in matches)
+    
+    keyboard = None
+    if has_more:
+        keyboard = {
+            'inline_keyboard': [
+                [{'text': 'Ещё ▶️', 'callback_data': f'matches_{matches[-1].id}'}]
+            ]
+        }
+    
+    return reply_message(bot_token, chat_id, "\n".join(lines), keyboard)
+
+
 def count_likes_today(cursor, my_id: int) -> int:
     """Подсчитать лайки за сегодня"""
     cursor.execute(
-        "SELECT COUNT(*) FROM likes WHERE from_user_id = %s AND created_at > NOW() - INTERVAL '24 hours'",
-        (my_id,)
+        "SELECT used FROM like_quota WHERE user_id = %s AND window_start > NOW() - %s",
+        (my_id, LIKE_QUOTA_WINDOW)
     )
-    return cursor.fetchone()[0]
+    row = cursor.fetchone()
+    return row[0] if row else 0
 
 
-def show_profile_card(bot_token: str, chat_id: int, profile: tuple, likes_count: int) -> dict:
-    """Показать карточку анкеты с кнопками"""
-    
-    gender_text = 'Парень' if profile[6] == 'male' else 'Девушка'
-    text = (
-        f"👤 {profile[3]}, {profile[4]}\n"
-        f"📍 {profile[5]}\n"
+def register_like(cursor, my_id: int, target_id: int) -> tuple:
+    """
+    Лайк, списание квоты, проверка взаимности и совпадение за один запрос.
+    Возвращает (лайков использовано или None при исчерпанной квоте,
+    был ли лайк раньше, взаимный ли он, имя и username анкеты).
+    """
+    cursor.execute(
+        "SELECT * FROM register_like(%s, %s, %s, %s)",
+        (my_id, target_id, DAILY_LIKE_LIMIT, LIKE_QUOTA_WINDOW)
+    )
+    return cursor.fetchone()
+
+
+def show_profile_card(bot_token: str, chat_id: int, profile: ProfileCard, likes_count: int,
+                      pending: Optional[List[Future]] = None, liked_me_waiting: int = 0) -> dict:
+    """Показать карточку анкеты с кнопками; liked_me_waiting — сколько лайков ждёт ответа"""
+    
+    text = ''
+    if liked_me_waiting:
+        text += f"💌 Эта анкета уже лайкнула тебя! Ждут ответа: {liked_me_waiting}\n\n"
+    
+    gender_text = 'Парень' if profile.gender == 'male' else 'Девушка'
+    text += (
+        f"👤 {profile.name}, {profile.age}\n"
+        f"📍 {profile.city}\n"
         f"👥 {gender_text}\n"
     )
     
-    if profile[8]:
-        text += f"\n💬 {profile[8]}\n"
+    if profile.bio:
+        text += f"\n💬 {profile.bio}\n"
     
-    text += f"\n❤️ Лайков сегодня: {likes_count}/15"
+    text += f"\n❤️ Лайков сегодня: {likes_count}/{DAILY_LIKE_LIMIT}"
     
     keyboard = {
         'inline_keyboard': [
             [
-                {'text': '❌ Пропустить', 'callback_data': f'skip_{profile[1]}'},
-                {'text': '❤️ Лайк', 'callback_data': f'like_{profile[1]}'}
+                {'text': '❌ Пропустить', 'callback_data': f'skip_{profile.telegram_id}'},
+                {'text': '❤️ Лайк', 'callback_data': f'like_{profile.telegram_id}'}
             ],
             [
-                {'text': '🚩 Пожаловаться', 'callback_data': f'report_{profile[1]}'}
+                {'text': '🚩 Пожаловаться', 'callback_data': f'report_{profile.telegram_id}'}
             ]
         ]
     }
     
-    import requests
-    requests.post(
-        f"https://api.telegram.org/bot{bot_token}/sendMessage",
-        json={
-            'chat_id': chat_id,
-            'text': text,
-            'reply_markup': keyboard
-        }
-    )
+    return reply_message(bot_token, chat_id, text, keyboard, pending)
+
+
+class TelegramClient:
+    """Клиент Bot API с общей keep-alive сессией"""
+    
+    def __init__(self, bot_token: str, api_url: str = TELEGRAM_API_URL):
+        self.base_url = f"{api_url}/bot{bot_token}"
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=TELEGRAM_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+    
+    def call(self, method: str, payload: dict, timeout: tuple = TELEGRAM_TIMEOUT) -> dict:
+        """Вызвать метод Bot API с повтором при 429 и обрыве соединения"""
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            is_last = attempt == TELEGRAM_MAX_RETRIES
+            
+            try:
+                response = self.session.post(
+                    f"{self.base_url}/{method}",
+                    json=payload,
+                    timeout=timeout
+                )
+            except requests.ConnectionError as e:
+                if is_last:
+                    return {'ok': False, 'description': str(e)}
+                continue
+            except requests.RequestException as e:
+                return {'ok': False, 'description': str(e)}
+            
+            try:
+                data = response.json()
+            except ValueError:
+                data = {'ok': False, 'error_code': response.status_code}
+            
+            if response.status_code == 429 and not is_last:
+                retry_after = data.get('parameters', {}).get('retry_after', 1)
+                if retry_after > TELEGRAM_MAX_RETRY_AFTER:
+                    return data
+                time.sleep(retry_after)
+                continue
+            
+            return data
+        
+        return {'ok': False}
+
+
+def get_telegram_client(bot_token: str) -> TelegramClient:
+    """Получить общий клиент для токена бота"""
+    client = _telegram_clients.get(bot_token)
+    if client is None:
+        client = TelegramClient(bot_token)
+        _telegram_clients[bot_token] = client
+    return client
+
+
+def telegram_api(bot_token: str, method: str, payload: dict) -> dict:
+    """Вызвать метод Bot API через общий клиент"""
+    metrics = _current_metrics.get()
+    if metrics is None:
+        return get_telegram_client(bot_token).call(method, payload)
     
-    return {'ok': True}
+    started = time.perf_counter()
+    try:
+        return get_telegram_client(bot_token).call(method, payload)
+    finally:
+        metrics.record_http(method, (time.perf_counter() - started) * 1000)
+
+
+def get_telegram_executor() -> ThreadPoolExecutor:
+    """Пул потоков для параллельных вызовов Bot API"""
+    global _telegram_executor
+    if _telegram_executor is None:
+        _telegram_executor = ThreadPoolExecutor(max_workers=TELEGRAM_POOL_SIZE, thread_name_prefix='telegram')
+    return _telegram_executor
+
+
+def dispatch_api(bot_token: str, method: str, payload: dict) -> Future:
+    """Запустить вызов Bot API в фоне, не дожидаясь ответа"""
+    # Копия контекста переносит замеры текущего апдейта в поток пула
+    context = contextvars.copy_context()
+    return get_telegram_executor().submit(context.run, telegram_api, bot_token, method, payload)
+
+
+def dispatch_message(bot_token: str, chat_id: int, text: str, reply_markup: Optional[dict] = None) -> Future:
+    """Отправить сообщение в фоне"""
+    return dispatch_api(bot_token, 'sendMessage', build_message_payload(chat_id, text, reply_markup))
 
 
-def send_message(bot_token: str, chat_id: int, text: str) -> dict:
+def wait_dispatched(pending: List[Future]) -> List[dict]:
+    """Дождаться завершения фоновых вызовов"""
+    return [future.result() for future in pending]
+
+
+def send_message(bot_token: str, chat_id: int, text: str, reply_markup: Optional[dict] = None) -> dict:
     """Отправить текстовое сообщение"""
-    import requests
-    response = requests.post(
-        f"https://api.telegram.org/bot{bot_token}/sendMessage",
-        json={'chat_id': chat_id, 'text': text}
-    )
+    telegram_api(bot_token, 'sendMessage', build_message_payload(chat_id, text, reply_markup))
     return {'ok': True}
 
 
+def reply_message(bot_token: str, chat_id: int, text: str, reply_markup: Optional[dict] = None,
+                  wait_for: Optional[List[Future]] = None) -> dict:
+    """Основной ответ на апдейт: вернуть его в теле webhook-ответа или отправить сразу"""
+    payload = build_message_payload(chat_id, text, reply_markup)
+    
+    # Ответ должен прийти после уже запущенных побочных вызовов
+    if wait_for:
+        wait_dispatched(wait_for)
+    
+    if not TELEGRAM_WEBHOOK_REPLY:
+        telegram_api(bot_token, 'sendMessage', payload)
+        return {'ok': True}
+    
+    return {'method': 'sendMessage', **payload}
+
+
+def build_message_payload(chat_id: int, text: str, reply_markup: Optional[dict] = None) -> dict:
+    """Собрать параметры sendMessage"""
+    payload = {'chat_id': chat_id, 'text': text}
+    if reply_markup:
+        payload['reply_markup'] = reply_markup
+    return payload
+
+
 def delete_message(bot_token: str, chat_id: int, message_id: int):
     """Удалить сообщение"""
-    import requests
-    requests.post(
-        f"https://api.telegram.org/bot{bot_token}/deleteMessage",
-        json={'chat_id': chat_id, 'message_id': message_id}
-    )
+    telegram_api(bot_token, 'deleteMessage', {'chat_id': chat_id, 'message_id': message_id})
 
 
 def answer_callback(bot_token: str, callback_id: int, text: str):
     """Ответить на callback"""
-    import requests
-    requests.post(
-        f"https://api.telegram.org/bot{bot_token}/answerCallbackQuery",
-        json={'callback_query_id': callback_id, 'text': text}
+    telegram_api(bot_token, 'answerCallbackQuery', {'callback_query_id': callback_id, 'text': text})
+
+
+def enqueue_message(cursor, chat_id: int, text: str, reply_markup: Optional[dict] = None) -> int:
+    """Поставить сообщение в исходящую очередь, вернуть его id"""
+    payload = build_message_payload(chat_id, text, reply_markup)
+    sends = _outbox_sends.get()
+    
+    # Внутри апдейта сообщение сразу берётся в аренду и отправляется, если у чата нет
+    # более ранних сообщений в очереди и в общем бюджете есть токен; иначе его отправит воркер
+    cursor.execute(
+        f"""WITH bucket AS (
+               SELECT {OUTBOX_BUDGET_SQL} AS available FROM outbox_rate
+               WHERE %(send_now)s
+               AND NOT EXISTS (SELECT 1 FROM outbox e WHERE e.status = 'pending' AND e.chat_id = %(chat_id)s)
+               FOR UPDATE
+           ), spent AS (
+               UPDATE outbox_rate SET tokens = b.available - 1, refilled_at = NOW()
+               FROM bucket b WHERE b.available >= 1
+               RETURNING 1
+           )
+           INSERT INTO outbox (chat_id, method, payload, attempts, next_attempt_at)
+           SELECT %(chat_id)s, 'sendMessage', %(payload)s,
+                  CASE WHEN s.leased THEN 1 ELSE 0 END,
+                  CASE WHEN s.leased THEN NOW() + %(lease)s ELSE NOW() END
+           FROM (SELECT EXISTS (SELECT 1 FROM spent) AS leased) s
+           RETURNING id, attempts""",
+        {
+            'chat_id': chat_id,
+            'payload': json.dumps(payload, ensure_ascii=False),
+            'send_now': sends is not None,
+            'lease': OUTBOX_LEASE,
+            'burst': OUTBOX_BURST,
+            'rate': OUTBOX_MESSAGES_PER_SECOND
+        }
     )
+    message_id, attempts = cursor.fetchone()
+    
+    if attempts:
+        bot_token, dispatched = sends
+        dispatched.append((message_id, attempts, dispatch_api(bot_token, 'sendMessage', payload)))
+    return message_id
 
 
-def show_pending_profiles(bot_token: str, chat_id: int, cursor) -> dict:
-    """Показать анкеты на модерации"""
+def dequeue_outbox(cursor, limit: int) -> Tuple[List[tuple], int]:
+    """
+    Взять в отправку пачку готовых сообщений, по одному на чат, в пределах общего бюджета.
+    Возвращает (пачку, сколько сообщений было готово к отправке, не больше limit).
+    """
+    # Берётся только самое старое сообщение чата: порядок внутри чата сохраняется,
+    # а аренда и SKIP LOCKED не дают двум воркерам отправить одно сообщение.
+    # Строка бюджета блокируется, только если есть что отправлять
     cursor.execute(
-        "SELECT id, telegram_id, name, age, city, gender, bio FROM profiles WHERE status = 'pending' ORDER BY created_at LIMIT 1"
+        f"""WITH due AS MATERIALIZED (
+               SELECT o.id, o.next_attempt_at FROM outbox o
+               WHERE o.status = 'pending' AND o.next_attempt_at <= NOW()
+               AND NOT EXISTS (SELECT 1 FROM outbox e
+                               WHERE e.status = 'pending' AND e.chat_id = o.chat_id AND e.id < o.id)
+               ORDER BY o.next_attempt_at, o.id
+               LIMIT %(limit)s
+               FOR UPDATE SKIP LOCKED
+           ), bucket AS MATERIALIZED (
+               SELECT {OUTBOX_BUDGET_SQL} AS available FROM outbox_rate
+               WHERE EXISTS (SELECT 1 FROM due)
+               FOR UPDATE
+           ), granted AS MATERIALIZED (
+               SELECT id FROM due
+               ORDER BY next_attempt_at, id
+               LIMIT (SELECT FLOOR(available)::INTEGER FROM bucket)
+           ), spent AS (
+               UPDATE outbox_rate SET tokens = b.available - (SELECT COUNT(*) FROM granted), refilled_at = NOW()
+               FROM bucket b
+           ), picked AS (
+               UPDATE outbox SET attempts = attempts + 1, next_attempt_at = NOW() + %(lease)s
+               WHERE id IN (SELECT id FROM granted)
+               RETURNING id, method, payload, attempts
+           )
+           SELECT (SELECT COUNT(*) FROM due), p.id, p.method, p.payload, p.attempts
+           FROM (SELECT 1) one LEFT JOIN picked p ON TRUE""",
+        {'lease': OUTBOX_LEASE, 'limit': limit, 'burst': OUTBOX_BURST, 'rate': OUTBOX_MESSAGES_PER_SECOND}
     )
+    rows = cursor.fetchall()
+    if not rows:
+        return [], 0
+    return [row[1:] for row in rows if row[1] is not None], rows[0][0]
+
+
+def dispatch_outbox(bot_token: str, batch: List[tuple]) -> List[tuple]:
+    """Запустить отправку взятых сообщений: [(id, попытка, Future)]"""
+    return [
+        (message_id, attempts, dispatch_api(bot_token, method, payload))
+        for message_id, method, payload, attempts in batch
+    ]
+
+
+def settle_outbox(cursor, dispatched: List[tuple]) -> int:
+    """Дождаться отправки и записать итог: отправленные удалить, остальные отложить; вернуть число отправленных"""
+    delivered = []
+    for message_id, attempts, future in dispatched:
+        result = future.result()
+        if result.get('ok'):
+            delivered.append(message_id)
+        else:
+            fail_outbox(cursor, message_id, attempts, result)
+    
+    if delivered:
+        complete_outbox(cursor, delivered)
+    return len(delivered)
+
+
+def complete_outbox(cursor, message_ids: List[int]):
+    """Удалить отправленные сообщения и сдвинуть следующие в тех же чатах"""
+    cursor.execute(
+        """WITH sent AS (
+               DELETE FROM outbox WHERE id = ANY(%(ids)s) RETURNING chat_id
+           )
+           UPDATE outbox SET next_attempt_at = GREATEST(next_attempt_at, NOW() + %(interval)s)
+           WHERE status = 'pending' AND chat_id IN (SELECT chat_id FROM sent) AND id <> ALL(%(ids)s)""",
+        {'ids': message_ids, 'interval': OUTBOX_CHAT_INTERVAL}
+    )
+
+
+def fail_outbox(cursor, message_id: int, attempts: int, result: dict):
+    """Отложить сообщение с экспоненциальной паузой или пометить как неотправляемое"""
+    retry_after = (result.get('parameters') or {}).get('retry_after')
+    delay = retry_after or min(2 ** attempts + random.random(), OUTBOX_MAX_BACKOFF)
+    
+    # 400 и 403: чат не найден или бот заблокирован, повтор не поможет
+    failed = result.get('error_code') in (400, 403) or attempts >= OUTBOX_MAX_ATTEMPTS
+    if failed:
+        log_event('outbox_failed', message_id=message_id, attempts=attempts,
+                  error_code=result.get('error_code'), error=result.get('description'))
+    
+    cursor.execute(
+        """UPDATE outbox SET status = %s, next_attempt_at = NOW() + %s, last_error = %s
+           WHERE id = %s""",
+        ('failed' if failed else 'pending', timedelta(seconds=delay), result.get('description'), message_id)
+    )
+
+
+def drain_outbox(bot_token: str, cursor, batch_size: int = OUTBOX_BATCH_SIZE,
+                 deadline: Optional[float] = None) -> int:
+    """Отправить готовые сообщения очереди: одну пачку или пачками до deadline"""
+    sent = 0
+    
+    while True:
+        batch, due = dequeue_outbox(cursor, batch_size)
+        sent += settle_outbox(cursor, dispatch_outbox(bot_token, batch))
+        
+        if deadline is None or (due < batch_size and len(batch) == due):
+            return sent
+        
+        # Готовые сообщения остались, но общий бюджет исчерпан: ждём, пока накопится пачка токенов
+        if len(batch) < due:
+            time.sleep(min(OUTBOX_BURST, due - len(batch)) / OUTBOX_MESSAGES_PER_SECOND)
+        
+        if time.monotonic() >= deadline:
+            return sent
+
+
+def run_outbox_worker(event: dict) -> dict:
+    """Воркер исходящей очереди, запускаемый таймером"""
+    headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+    if not OUTBOX_WORKER_TOKEN or not hmac.compare_digest(headers.get('x-worker-token', ''), OUTBOX_WORKER_TOKEN):
+        return {
+            'statusCode': 403,
+            'headers': {'Content-Type': 'application/json'},
+            'body': json.dumps({'error': 'Forbidden'})
+        }
     
-    profile = cursor.fetchone()
+    bot_token = os.environ.get('TELEGRAM_BOT_TOKEN')
+    db_url = os.environ.get('DATABASE_URL')
+    schema = os.environ.get('MAIN_DB_SCHEMA', 'public')
+    
+    if not bot_token or not db_url:
+        return error_response('Missing configuration')
+    
+    try:
+        with pooled_cursor(db_url, schema) as cursor:
+            sent = drain_outbox(bot_token, cursor, deadline=time.monotonic() + OUTBOX_DRAIN_SECONDS)
+    except Exception as e:
+        return error_response(str(e))
+    
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json'},
+        'body': json.dumps({'sent': sent})
+    }
+
+
+def claim_pending_profile(cursor, moderator_id: int) -> Optional[PendingProfile]:
+    """Взять в работу самую старую свободную анкету на модерации"""
+    # SKIP LOCKED и аренда не дают двум модераторам получить одну анкету
+    cursor.execute(
+        f"""UPDATE profiles SET claimed_by = %(moderator_id)s, claimed_until = NOW() + %(lease)s
+           WHERE id = (
+               SELECT id FROM profiles
+               WHERE status = 'pending'
+               AND {UNCLAIMED_SQL}
+               ORDER BY created_at
+               LIMIT 1
+               FOR UPDATE SKIP LOCKED
+           )
+           RETURNING {PENDING_PROFILE_COLUMNS}""",
+        {'moderator_id': moderator_id, 'lease': MODERATION_LEASE}
+    )
+    row = cursor.fetchone()
+    return PendingProfile._make(row) if row else None
+
+
+def claim_pending_report(cursor, moderator_id: int) -> Optional[tuple]:
+    """Взять в работу самую старую свободную жалобу"""
+    cursor.execute(
+        f"""WITH claimed AS (
+               UPDATE reports SET claimed_by = %(moderator_id)s, claimed_until = NOW() + %(lease)s
+               WHERE id = (
+                   SELECT id FROM reports
+                   WHERE status = 'pending'
+                   AND {UNCLAIMED_SQL}
+                   ORDER BY created_at
+                   LIMIT 1
+                   FOR UPDATE SKIP LOCKED
+               )
+               RETURNING id, reporter_id, reported_user_id, reason
+           )
+           SELECT c.id, c.reporter_id, c.reported_user_id, c.reason,
+                  COALESCE(p1.name, '—') as reporter_name, COALESCE(p2.name, '—') as reported_name
+           FROM claimed c
+           LEFT JOIN profiles p1 ON c.reporter_id = p1.telegram_id
+           LEFT JOIN profiles p2 ON c.reported_user_id = p2.telegram_id""",
+        {'moderator_id': moderator_id, 'lease': MODERATION_LEASE}
+    )
+    return cursor.fetchone()
+
+
+def show_pending_profiles(bot_token: str, chat_id: int, cursor, pending: Optional[List[Future]] = None) -> dict:
+    """Показать анкеты на модерации"""
+    profile = claim_pending_profile(cursor, chat_id)
     if not profile:
-        return send_message(bot_token, chat_id, "✅ Нет анкет на модерации")
+        return reply_message(bot_token, chat_id, "✅ Нет анкет на модерации", wait_for=pending)
     
-    gender_text = 'Парень' if profile[5] == 'male' else 'Девушка'
+    gender_text = 'Парень' if profile.gender == 'male' else 'Девушка'
     text = (
         f"🔍 Анкета на проверку:\n\n"
-        f"👤 {profile[2]}, {profile[3]}\n"
-        f"📍 {profile[4]}\n"
+        f"👤 {profile.name}, {profile.age}\n"
+        f"📍 {profile.city}\n"
         f"👥 {gender_text}\n"
     )
     
-    if profile[6]:
-        text += f"💬 {profile[6]}\n"
+    if profile.bio:
+        text += f"💬 {profile.bio}\n"
     
-    text += f"\n🆔 Telegram ID: {profile[1]}"
+    text += f"\n🆔 Telegram ID: {profile.telegram_id}"
     
     keyboard = {
         'inline_keyboard': [
             [
-                {'text': '❌ Отклонить', 'callback_data': f'mod_reject_{profile[0]}'},
-                {'text': '✅ Одобрить', 'callback_data': f'mod_approve_{profile[0]}'}
+                {'text': '❌ Отклонить', 'callback_data': f'mod_reject_{profile.id}'},
+                {'text': '✅ Одобрить', 'callback_data': f'mod_approve_{profile.id}'}
             ]
         ]
     }
     
-    import requests
-    requests.post(
-        f"https://api.telegram.org/bot{bot_token}/sendMessage",
-        json={'chat_id': chat_id, 'text': text, 'reply_markup': keyboard}
-    )
-    
-    return {'ok': True}
+    return reply_message(bot_token, chat_id, text, keyboard, pending)
 
 
-def show_reports(bot_token: str, chat_id: int, cursor) -> dict:
+def show_reports(bot_token: str, chat_id: int, cursor, pending: Optional[List[Future]] = None) -> dict:
     """Показать жалобы"""
-    cursor.execute(
-        """SELECT r.id, r.reporter_id, r.reported_user_id, r.reason,
-                  p1.name as reporter_name, p2.name as reported_name
-           FROM reports r
-           JOIN profiles p1 ON r.reporter_id = p1.telegram_id
-           JOIN profiles p2 ON r.reported_user_id = p2.telegram_id
-           WHERE r.status = 'pending'
-           ORDER BY r.created_at
-           LIMIT 1"""
-    )
-    
-    report = cursor.fetchone()
+    report = claim_pending_report(cursor, chat_id)
     if not report:
-        return send_message(bot_token, chat_id, "✅ Нет активных жалоб")
+        return reply_message(bot_token, chat_id, "✅ Нет активных жалоб", wait_for=pending)
     
     text = (
         f"🚩 Жалоба #{report[0]}:\n\n"
@@ -550,31 +1819,18 @@ def show_reports(bot_token: str, chat_id: int, cursor) -> dict:
         ]
     }
     
-    import requests
-    requests.post(
-        f"https://api.telegram.org/bot{bot_token}/sendMessage",
-        json={'chat_id': chat_id, 'text': text, 'reply_markup': keyboard}
-    )
-    
-    return {'ok': True}
+    return reply_message(bot_token, chat_id, text, keyboard, pending)
 
 
 def show_stats(bot_token: str, chat_id: int, cursor) -> dict:
     """Показать статистику"""
-    cursor.execute("SELECT COUNT(*) FROM profiles WHERE status = 'approved'")
-    approved = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM profiles WHERE status = 'pending'")
-    pending = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM matches")
-    matches = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM reports WHERE status = 'pending'")
-    reports = cursor.fetchone()[0]
-    
-    cursor.execute("SELECT COUNT(*) FROM likes WHERE created_at > NOW() - INTERVAL '24 hours'")
-    likes_today = cursor.fetchone()[0]
+    cursor.execute(
+        """SELECT c.approved_profiles, c.pending_profiles, c.rejected_profiles, c.matches, c.pending_reports,
+                  (SELECT COALESCE(SUM(h.likes), 0) FROM likes_hourly h
+                   WHERE h.bucket > NOW() - INTERVAL '24 hours')
+           FROM stats_counters c"""
+    )
+    approved, pending, _, matches, reports, likes_today = cursor.fetchone()
     
     text = (
         f"📊 Статистика бота:\n\n"
@@ -585,71 +1841,98 @@ def show_stats(bot_token: str, chat_id: int, cursor) -> dict:
         f"❤️ Лайков за 24ч: {likes_today}"
     )
     
-    return send_message(bot_token, chat_id, text)
+    return reply_message(bot_token, chat_id, text)
 
 
 def mod_approve_profile(bot_token: str, chat_id: int, profile_id: int, cursor, message_id: int) -> dict:
     """Модератор одобряет анкету"""
+    # Решение меняет только ещё не решённую анкету, не взятую другим модератором
     cursor.execute(
-        "UPDATE profiles SET status = 'approved', updated_at = NOW() WHERE id = %s RETURNING telegram_id, name",
-        (profile_id,)
+        f"""UPDATE profiles SET status = 'approved', updated_at = NOW()
+           WHERE id = %(id)s AND status = 'pending' AND {UNCLAIMED_SQL}
+           RETURNING telegram_id, name""",
+        {'id': profile_id, 'moderator_id': chat_id}
     )
     
     result = cursor.fetchone()
     if result:
         user_id, name = result
-        send_message(bot_token, user_id, f"✅ Твоя анкета одобрена!\n\nТеперь ты можешь смотреть анкеты командой /browse")
-        delete_message(bot_token, chat_id, message_id)
-        send_message(bot_token, chat_id, f"✅ Анкета {name} одобрена")
-        show_pending_profiles(bot_token, chat_id, cursor)
+        _profile_cache.invalidate(user_id)
+        enqueue_message(cursor, user_id, f"✅ Твоя анкета одобрена!\n\nТеперь ты можешь смотреть анкеты командой /browse")
+        pending = [
+            dispatch_api(bot_token, 'deleteMessage', {'chat_id': chat_id, 'message_id': message_id}),
+            dispatch_message(bot_token, chat_id, f"✅ Анкета {name} одобрена")
+        ]
+        return show_pending_profiles(bot_token, chat_id, cursor, pending)
     
-    return {'ok': True}
+    pending = [
+        dispatch_api(bot_token, 'deleteMessage', {'chat_id': chat_id, 'message_id': message_id}),
+        dispatch_message(bot_token, chat_id, STALE_MODERATION_MESSAGE)
+    ]
+    return show_pending_profiles(bot_token, chat_id, cursor, pending)
 
 
 def mod_reject_profile(bot_token: str, chat_id: int, profile_id: int, cursor, message_id: int) -> dict:
     """Модератор отклоняет анкету"""
+    # Решение меняет только ещё не решённую анкету, не взятую другим модератором
     cursor.execute(
-        "UPDATE profiles SET status = 'rejected', updated_at = NOW() WHERE id = %s RETURNING telegram_id, name",
-        (profile_id,)
+        f"""UPDATE profiles SET status = 'rejected', updated_at = NOW()
+           WHERE id = %(id)s AND status = 'pending' AND {UNCLAIMED_SQL}
+           RETURNING telegram_id, name""",
+        {'id': profile_id, 'moderator_id': chat_id}
     )
     
     result = cursor.fetchone()
     if result:
         user_id, name = result
-        send_message(bot_token, user_id, f"❌ Твоя анкета отклонена.\n\nВозможные причины:\n- Неподходящее фото\n- Некорректные данные\n\nСоздай новую анкету командой /create")
-        delete_message(bot_token, chat_id, message_id)
-        send_message(bot_token, chat_id, f"❌ Анкета {name} отклонена")
-        show_pending_profiles(bot_token, chat_id, cursor)
+        _profile_cache.invalidate(user_id)
+        invalidate_browse_queue(cursor, user_id)
+        enqueue_message(cursor, user_id, f"❌ Твоя анкета отклонена.\n\nВозможные причины:\n- Неподходящее фото\n- Некорректные данные\n\nСоздай новую анкету командой /create")
+        pending = [
+            dispatch_api(bot_token, 'deleteMessage', {'chat_id': chat_id, 'message_id': message_id}),
+            dispatch_message(bot_token, chat_id, f"❌ Анкета {name} отклонена")
+        ]
+        return show_pending_profiles(bot_token, chat_id, cursor, pending)
     
-    return {'ok': True}
+    pending = [
+        dispatch_api(bot_token, 'deleteMessage', {'chat_id': chat_id, 'message_id': message_id}),
+        dispatch_message(bot_token, chat_id, STALE_MODERATION_MESSAGE)
+    ]
+    return show_pending_profiles(bot_token, chat_id, cursor, pending)
 
 
 def mod_resolve_report(bot_token: str, chat_id: int, report_id: int, cursor, message_id: int) -> dict:
     """Модератор принимает меры по жалобе"""
     cursor.execute(
-        "UPDATE reports SET status = 'resolved' WHERE id = %s",
-        (report_id,)
+        f"""UPDATE reports SET status = 'resolved'
+           WHERE id = %(id)s AND status = 'pending' AND {UNCLAIMED_SQL}
+           RETURNING id""",
+        {'id': report_id, 'moderator_id': chat_id}
     )
+    text = f"✅ Жалоба #{report_id} обработана" if cursor.fetchone() else STALE_MODERATION_MESSAGE
     
-    delete_message(bot_token, chat_id, message_id)
-    send_message(bot_token, chat_id, f"✅ Жалоба #{report_id} обработана")
-    show_reports(bot_token, chat_id, cursor)
-    
-    return {'ok': True}
+    pending = [
+        dispatch_api(bot_token, 'deleteMessage', {'chat_id': chat_id, 'message_id': message_id}),
+        dispatch_message(bot_token, chat_id, text)
+    ]
+    return show_reports(bot_token, chat_id, cursor, pending)
 
 
 def mod_dismiss_report(bot_token: str, chat_id: int, report_id: int, cursor, message_id: int) -> dict:
     """Модератор отклоняет жалобу"""
     cursor.execute(
-        "UPDATE reports SET status = 'dismissed' WHERE id = %s",
-        (report_id,)
+        f"""UPDATE reports SET status = 'dismissed'
+           WHERE id = %(id)s AND status = 'pending' AND {UNCLAIMED_SQL}
+           RETURNING id""",
+        {'id': report_id, 'moderator_id': chat_id}
     )
+    text = f"❌ Жалоба #{report_id} отклонена" if cursor.fetchone() else STALE_MODERATION_MESSAGE
     
-    delete_message(bot_token, chat_id, message_id)
-    send_message(bot_token, chat_id, f"❌ Жалоба #{report_id} отклонена")
-    show_reports(bot_token, chat_id, cursor)
-    
-    return {'ok': True}
+    pending = [
+        dispatch_api(bot_token, 'deleteMessage', {'chat_id': chat_id, 'message_id': message_id}),
+        dispatch_message(bot_token, chat_id, text)
+    ]
+    return show_reports(bot_token, chat_id, cursor, pending)
 
 
 def error_response(message: str) -> dict:
@@ -658,4 +1941,131 @@ def error_response(message: str) -> dict:
         'statusCode': 500,
         'headers': {'Content-Type': 'application/json'},
         'body': json.dumps({'error': message})
-    }
\ No newline at end of file
+    }
+
+
+def run_polling(bot_token: str, db_url: str, schema: str, stop: threading.Event):
+    """Цикл getUpdates вместо вебхука: апдейты разных чатов обрабатываются параллельно"""
+    client = get_telegram_client(bot_token)
+    
+    # При установленном вебхуке getUpdates отвечает 409
+    client.call('deleteWebhook', {})
+    
+    outbox_worker = threading.Thread(
+        target=run_outbox_loop, args=(bot_token, db_url, schema, stop), name='outbox', daemon=True
+    )
+    outbox_worker.start()
+    
+    offset = None
+    attempts: Dict[int, int] = {}
+    log_event('polling_started', workers=POLLING_WORKERS)
+    
+    with ThreadPoolExecutor(max_workers=POLLING_WORKERS, thread_name_prefix='updates') as executor:
+        while not stop.is_set():
+            payload = {
+                'timeout': POLLING_TIMEOUT,
+                'limit': POLLING_LIMIT,
+                'allowed_updates': ['message', 'callback_query']
+            }
+            if offset is not None:
+                payload['offset'] = offset
+            
+            result = client.call('getUpdates', payload, timeout=(TELEGRAM_TIMEOUT[0], POLLING_TIMEOUT + TELEGRAM_TIMEOUT[1]))
+            if not result.get('ok'):
+                log_event('polling_error', error_code=result.get('error_code'), error=result.get('description'))
+                stop.wait(POLLING_ERROR_DELAY)
+                continue
+            
+            updates = result['result']
+            if not updates:
+                continue
+            
+            chats: Dict[Optional[int], List[dict]] = {}
+            for update in updates:
+                chats.setdefault(update_chat_id(update), []).append(update)
+            
+            # Апдейты одного чата идут по порядку в одной задаче, чаты — параллельно
+            futures = [
+                executor.submit(process_chat_updates, chat_updates, bot_token, db_url, schema)
+                for chat_updates in chats.values()
+            ]
+            failed = [update_id for update_id in (future.result() for future in futures) if update_id is not None]
+            
+            offset = next_polling_offset(updates, failed, attempts)
+            if failed:
+                stop.wait(POLLING_ERROR_DELAY)
+    
+    outbox_worker.join()
+    log_event('polling_stopped')
+
+
+def update_chat_id(update: dict) -> Optional[int]:
+    """Чат, к которому относится апдейт"""
+    if 'message' in update:
+        return update['message']['chat']['id']
+    if 'callback_query' in update:
+        return update['callback_query']['message']['chat']['id']
+    return None
+
+
+def process_chat_updates(updates: List[dict], bot_token: str, db_url: str, schema: str) -> Optional[int]:
+    """Обработать апдейты одного чата по порядку; вернуть id первого упавшего"""
+    for update in updates:
+        try:
+            response = run_update(update, bot_token, db_url, schema, polling=True)
+        except Exception as e:
+            log_event('update_failed', update_id=update.get('update_id'), error=str(e))
+            return update['update_id']
+        
+        # Ответ, который вебхук вернул бы в теле, здесь отправляется сам
+        if response and 'method' in response:
+            payload = {key: value for key, value in response.items() if key != 'method'}
+            telegram_api(bot_token, response['method'], payload)
+    
+    return None
+
+
+def next_polling_offset(updates: List[dict], failed: List[int], attempts: Dict[int, int]) -> int:
+    """Подтвердить апдейты до первого упавшего; после POLLING_MAX_ATTEMPTS апдейт пропускается"""
+    # Апдейты после упавшего придут снова: завершённые отсеет claim_update, а апдейты
+    # того же чата, до которых его задача не дошла, будут обработаны
+    offset = max(update['update_id'] for update in updates) + 1
+    if failed:
+        update_id = min(failed)
+        attempts[update_id] = attempts.get(update_id, 0) + 1
+        if attempts[update_id] < POLLING_MAX_ATTEMPTS:
+            offset = update_id
+        else:
+            log_event('update_dropped', update_id=update_id, attempts=attempts[update_id])
+            offset = update_id + 1
+    
+    for update_id in [update_id for update_id in attempts if update_id < offset]:
+        del attempts[update_id]
+    return offset
+
+
+def run_outbox_loop(bot_token: str, db_url: str, schema: str, stop: threading.Event):
+    """Фоновый воркер исходящей очереди в polling-режиме"""
+    while not stop.is_set():
+        sent = 0
+        try:
+            with pooled_cursor(db_url, schema) as cursor:
+                sent = drain_outbox(bot_token, cursor, deadline=time.monotonic() + OUTBOX_DRAIN_SECONDS)
+        except Exception as e:
+            log_event('outbox_drain_failed', error=str(e))
+        
+        if not sent:
+            stop.wait(OUTBOX_POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+    stop_polling = threading.Event()
+    signal.signal(signal.SIGINT, lambda *_: stop_polling.set())
+    signal.signal(signal.SIGTERM, lambda *_: stop_polling.set())
+    
+    run_polling(
+        os.environ['TELEGRAM_BOT_TOKEN'],
+        os.environ['DATABASE_URL'],
+        os.environ.get('MAIN_DB_SCHEMA', 'public'),
+        stop_polling
+    )
@@ -0,0 +1,69 @@
+"""
+Бенчмарк выбора анкет: ORDER BY RANDOM() против пула по random_key.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python bench/candidate_selection.py --sizes 10000,100000,1000000
+
+Старый запрос отдаёт одну анкету, новый путь замеряется напрямую: fetch_candidates —
+выборка пула с признаками, refill — полное пополнение очереди на BROWSE_QUEUE_BATCH анкет
+(пул, ранжирование, вставка). Очередь зрителя очищается перед каждым замером.
+"""
+import argparse
+
+from common import apply_migrations, connect, load_function, measure, seed_likes, seed_profiles, summarize
+
+LEGACY_QUERY = """SELECT * FROM profiles
+                  WHERE telegram_id != %s
+                  AND status = 'approved'
+                  AND telegram_id NOT IN (SELECT to_user_id FROM likes WHERE from_user_id = %s)
+                  ORDER BY RANDOM()
+                  LIMIT 1"""
+
+
+def run(size: int, repeat: int, likes: int):
+    conn = connect('bench_candidates')
+    cursor = conn.cursor()
+    apply_migrations(cursor)
+    seed_profiles(cursor, size)
+    
+    viewer_id = 1_000_001
+    seed_likes(cursor, viewer_id, likes, total=size)
+    cursor.execute('ANALYZE likes')
+    
+    bot = load_function('telegram-bot')
+    
+    def legacy():
+        cursor.execute(LEGACY_QUERY, (viewer_id, viewer_id))
+        cursor.fetchone()
+    
+    def clear_queue():
+        cursor.execute("DELETE FROM browse_queue WHERE user_id = %s", (viewer_id,))
+    
+    viewer = bot.get_profile(cursor, viewer_id)
+    filter_sql = bot.feed_filter_sql(viewer, bot.FEED_FILTER_LEVELS[0])
+    
+    stats = {
+        'random()': summarize(measure(legacy, repeat)),
+        'fetch': summarize(measure(lambda: bot.fetch_candidates(cursor, viewer_id, viewer, filter_sql), repeat)),
+        'refill': summarize(measure(lambda: bot.refill_browse_queue(cursor, viewer_id), repeat, setup=clear_queue))
+    }
+    
+    cursor.close()
+    conn.close()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='10000,100000,1000000')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--likes', type=int, default=500)
+    args = parser.parse_args()
+    
+    print(f"{'profiles':>10} | {'query':<12} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8}")
+    for size in (int(value) for value in args.sizes.split(',')):
+        for label, stats in run(size, args.repeat, args.likes).items():
+            print(f"{size:>10} | {label:<12} | {stats['p50']:>8.2f} | {stats['p95']:>8.2f} | {stats['p99']:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+Регрессионная проверка планов: ни один горячий запрос обеих функций
+не должен читать большие таблицы последовательным сканированием.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python bench/check_query_plans.py --profiles 200000
+
+Код выхода 1, если хотя бы один план содержит Seq Scan по большой таблице.
+"""
+import argparse
+import sys
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple
+
+from common import (apply_migrations, connect, load_function, seed_activity, seed_feed_state, seed_outbox,
+                    seed_profiles)
+
+BIG_TABLES = {'profiles', 'likes', 'matches', 'reports', 'browse_queue', 'skips', 'like_quota', 'processed_updates',
+              'outbox'}
+
+FIRST_ID = 1_000_000
+VIEWER_ID = FIRST_ID + 1
+TARGET_ID = FIRST_ID + 3
+
+# Строка fetch_candidates: (telegram_id, возраст, тот же город, дней с создания, часов с активности)
+CANDIDATE_ROW = (TARGET_ID, 16, 1, 3.0, 5.0)
+
+# Запросы внутри register_like(): EXPLAIN самого вызова их не показывает
+REGISTER_LIKE_STATEMENTS = [
+    ("SELECT 1 FROM likes l WHERE l.from_user_id = %s AND l.to_user_id = %s", (VIEWER_ID, TARGET_ID)),
+    ("SELECT q.used FROM like_quota q WHERE q.user_id = %s AND q.window_start > NOW() - INTERVAL '24 hours'",
+     (VIEWER_ID,)),
+    ("SELECT p.name, p.username FROM profiles p WHERE p.telegram_id = %s", (TARGET_ID,)),
+]
+
+
+class ExplainCursor:
+    """
+    Курсор, который вместо выполнения запросов собирает их планы.
+    Выборки по очереди отдают заготовленные results, иначе пусто.
+    """
+    
+    def __init__(self, cursor, results: Optional[List[list]] = None):
+        self.cursor = cursor
+        self.connection = cursor.connection
+        self.plans: List[Tuple[str, dict]] = []
+        self.results = list(results or [])
+        self.rowcount = 0
+    
+    def execute(self, query: str, params=None):
+        self.cursor.execute('EXPLAIN (FORMAT JSON) ' + query, params)
+        self.plans.append((query, self.cursor.fetchone()[0][0]['Plan']))
+    
+    def fetchone(self):
+        rows = self.fetchall()
+        return rows[0] if rows else None
+    
+    def fetchall(self):
+        return self.results.pop(0) if self.results else []
+    
+    def close(self):
+        pass
+
+
+def find_seq_scans(plan: dict) -> List[str]:
+    """Большие таблицы, которые план читает последовательно"""
+    found = []
+    if plan.get('Node Type') == 'Seq Scan' and plan.get('Relation Name') in BIG_TABLES:
+        found.append(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        found.extend(find_seq_scans(child))
+    return found
+
+
+def refill_with_preferences(bot, cursor) -> int:
+    """Лента зрителя со всеми предпочтениями: проходит все ступени расширения фильтра"""
+    viewer = bot.Profile(VIEWER_ID, 'Bench', 16, 'Москва', 'male', '', 'approved', 'female', 15, 17, True)
+    bot._profile_cache.put(VIEWER_ID, viewer)
+    try:
+        return bot.refill_browse_queue(cursor, VIEWER_ID)
+    finally:
+        bot._profile_cache.invalidate(VIEWER_ID)
+
+
+def returning(results: List[list], call: Callable) -> Callable:
+    """Путь, которому нужны строки из выборок, чтобы дойти до следующих запросов"""
+    def run(cursor: ExplainCursor):
+        cursor.results = list(results)
+        return call(cursor)
+    return run
+
+
+def with_viewer(bot, call: Callable) -> Callable:
+    """Путь, читающий анкету зрителя из кэша"""
+    def run(cursor: ExplainCursor):
+        bot._profile_cache.put(VIEWER_ID, bot.Profile(VIEWER_ID, 'Bench', 16, 'Москва', 'male', '', 'approved',
+                                                      None, None, None, False))
+        try:
+            return call(cursor)
+        finally:
+            bot._profile_cache.invalidate(VIEWER_ID)
+    return run
+
+
+def offline_dispatch(bot_token: str, method: str, payload: dict) -> Future:
+    """Вызовы Bot API в проверке планов не выполняются"""
+    future = Future()
+    future.set_result({'ok': True})
+    return future
+
+
+def hot_paths(bot, api) -> List[Tuple[str, Callable]]:
+    """Горячие пути обеих функций; каждый вызывается с ExplainCursor"""
+    return [
+        ('bot.claim_update', lambda c: bot.claim_update(c, 123456)),
+        ('bot.complete_update', lambda c: bot.complete_update(c, 123456, {'ok': True})),
+        ('bot.release_update', lambda c: bot.release_update(c, 123456)),
+        ('bot.get_profile', lambda c: bot.get_profile(c, VIEWER_ID)),
+        ('bot.get_next_profile', lambda c: bot.get_next_profile(c, VIEWER_ID)),
+        ('bot.pop_liked_me', lambda c: bot.pop_liked_me(c, VIEWER_ID)),
+        ('bot.refill_browse_queue', lambda c: bot.refill_browse_queue(c, VIEWER_ID)),
+        ('bot.refill_browse_queue.preferences', lambda c: refill_with_preferences(bot, c)),
+        ('bot.insert_browse_batch', returning([[CANDIDATE_ROW]],
+                                              lambda c: bot.insert_browse_batch(c, VIEWER_ID, None, ''))),
+        ('bot.handle_skip', lambda c: bot.handle_skip('token', VIEWER_ID, TARGET_ID, c, 1)),
+        ('bot.update_preferences', with_viewer(bot, lambda c: bot.update_preferences('token', VIEWER_ID, c,
+                                                                                      '/age', '15-17'))),
+        ('bot.invalidate_browse_queue', lambda c: bot.invalidate_browse_queue(c, TARGET_ID)),
+        ('bot.count_likes_today', lambda c: bot.count_likes_today(c, VIEWER_ID)),
+        ('bot.register_like', lambda c: bot.register_like(c, VIEWER_ID, TARGET_ID)),
+        ('bot.get_matches', lambda c: bot.get_matches(c, VIEWER_ID)),
+        ('bot.get_matches.page', lambda c: bot.get_matches(c, VIEWER_ID, 1000)),
+        ('bot.claim_pending_profile', lambda c: bot.claim_pending_profile(c, VIEWER_ID)),
+        ('bot.claim_pending_report', lambda c: bot.claim_pending_report(c, VIEWER_ID)),
+        ('bot.mod_approve_profile', returning([[(TARGET_ID, 'Bench')], [(1, 0)]],
+                                              lambda c: bot.mod_approve_profile('token', VIEWER_ID, 5, c, 1))),
+        ('bot.mod_reject_profile', returning([[(TARGET_ID, 'Bench')], [(1, 0)]],
+                                             lambda c: bot.mod_reject_profile('token', VIEWER_ID, 5, c, 1))),
+        ('bot.mod_resolve_report', lambda c: bot.mod_resolve_report('token', VIEWER_ID, 5, c, 1)),
+        ('bot.mod_dismiss_report', lambda c: bot.mod_dismiss_report('token', VIEWER_ID, 5, c, 1)),
+        ('bot.show_stats', lambda c: bot.show_stats('token', VIEWER_ID, c)),
+        ('bot.dequeue_outbox', lambda c: bot.dequeue_outbox(c, bot.OUTBOX_BATCH_SIZE)),
+        ('bot.enqueue_message', lambda c: bot.enqueue_message(c, TARGET_ID, 'Bench')),
+        ('bot.complete_outbox', lambda c: bot.complete_outbox(c, [1, 2, 3])),
+        ('bot.fail_outbox', lambda c: bot.fail_outbox(c, 1, 1, {'ok': False, 'error_code': 502})),
+        ('api.get_pending_profiles', lambda c: api.get_pending_profiles(c)),
+        ('api.get_pending_profiles.page', lambda c: api.get_pending_profiles(c, '2024-01-01T00:00:00,1000')),
+        ('api.get_reports', lambda c: api.get_reports(c)),
+        ('api.get_reports.page', lambda c: api.get_reports(c, '2024-01-01T00:00:00,1000')),
+        ('api.get_stats', lambda c: api.get_stats(c)),
+        ('api.approve_profile', lambda c: api.approve_profile(c, 5)),
+        ('api.reject_profile', returning([[(TARGET_ID,)]], lambda c: api.reject_profile(c, 5))),
+        ('api.update_report', lambda c: api.update_report(c, 5, 'resolved')),
+        ('api.approve_profiles_batch', lambda c: api.approve_profiles_batch(c, [5, 6, 7])),
+        ('api.lease_notifications', lambda c: api.lease_notifications(c, [1, 2, 3])),
+        ('api.complete_notifications', lambda c: api.complete_notifications(c, [1, 2, 3])),
+        ('api.update_reports_batch', lambda c: api.update_reports_batch(c, [5, 6, 7], 'resolved')),
+        ('api.claim_profile', lambda c: api.claim_profile(c, VIEWER_ID)),
+        ('api.claim_report', lambda c: api.claim_report(c, VIEWER_ID)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--profiles', type=int, default=200_000)
+    args = parser.parse_args()
+    
+    conn = connect('bench_query_plans')
+    cursor = conn.cursor()
+    apply_migrations(cursor)
+    seed_profiles(cursor, args.profiles, FIRST_ID)
+    seed_activity(cursor, args.profiles, likes=args.profiles * 5, matches=args.profiles // 4,
+                  reports=args.profiles // 10, first_id=FIRST_ID)
+    seed_feed_state(cursor, args.profiles, queued_users=args.profiles // 5, skips=args.profiles * 3,
+                    quota_users=args.profiles // 3, updates=args.profiles, first_id=FIRST_ID)
+    seed_outbox(cursor, args.profiles, count=args.profiles // 2, first_id=FIRST_ID)
+    
+    bot = load_function('telegram-bot')
+    api = load_function('moderator-api')
+    bot.dispatch_api = offline_dispatch
+    
+    failures = []
+    checked = 0
+    
+    for name, call in hot_paths(bot, api):
+        explain = ExplainCursor(cursor)
+        try:
+            call(explain)
+        except (TypeError, IndexError):
+            # Пустые результаты ExplainCursor ломают разбор ответа, планы уже собраны
+            pass
+        
+        for query, plan in explain.plans:
+            checked += 1
+            for table in find_seq_scans(plan):
+                failures.append(f"{name}: Seq Scan on {table}\n    {' '.join(query.split())[:160]}")
+    
+    for query, params in REGISTER_LIKE_STATEMENTS:
+        explain = ExplainCursor(cursor)
+        explain.execute(query, params)
+        checked += 1
+        for table in find_seq_scans(explain.plans[0][1]):
+            failures.append(f"register_like(): Seq Scan on {table}\n    {query}")
+    
+    cursor.close()
+    conn.close()
+    
+    print(f"Checked {checked} query plans on {args.profiles} profiles")
+    for failure in failures:
+        print(f"FAIL {failure}")
+    
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+"""
+Общие помощники для бенчмарков: локальная БД, миграции, загрузка функций.
+Подключение берётся из BENCH_DATABASE_URL (или DATABASE_URL).
+"""
+import importlib.util
+import os
+import statistics
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import psycopg2
+
+ROOT = Path(__file__).resolve().parent.parent
+MIGRATIONS_DIR = ROOT / 'db_migrations'
+FUNCTIONS_DIR = ROOT / 'backend'
+
+CITIES = ['Москва', 'Санкт-Петербург', 'Казань', 'Новосибирск', 'Екатеринбург']
+
+
+def get_database_url() -> str:
+    """Строка подключения к локальной БД для бенчмарков"""
+    db_url = os.environ.get('BENCH_DATABASE_URL') or os.environ.get('DATABASE_URL')
+    if not db_url:
+        raise SystemExit('Set BENCH_DATABASE_URL to a local PostgreSQL database')
+    return db_url
+
+
+def connect(schema: str):
+    """Подключиться и пересоздать отдельную схему под бенчмарк"""
+    conn = psycopg2.connect(get_database_url())
+    conn.autocommit = True
+    with conn.cursor() as cursor:
+        cursor.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+        cursor.execute(f'CREATE SCHEMA {schema}')
+        cursor.execute(f'SET search_path TO {schema}')
+    return conn
+
+
+def apply_migrations(cursor):
+    """Применить все миграции по порядку версий"""
+    for path in sorted(MIGRATIONS_DIR.glob('V*.sql')):
+        cursor.execute(path.read_text(encoding='utf-8'))
+
+
+def load_function(name: str):
+    """Загрузить index.py облачной функции как модуль"""
+    path = FUNCTIONS_DIR / name / 'index.py'
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@contextmanager
+def bulk_load(cursor, *tables: str):
+    """Массовая вставка без пользовательских триггеров, счётчики статистики пересчитываются после"""
+    # Построчный триггер лайков пишет в likes_hourly на каждую вставленную строку,
+    # и миллионы лайков вставлялись бы десятки минут
+    for table in tables:
+        cursor.execute(f'ALTER TABLE {table} DISABLE TRIGGER USER')
+    try:
+        yield
+    finally:
+        for table in tables:
+            cursor.execute(f'ALTER TABLE {table} ENABLE TRIGGER USER')
+        refresh_stats(cursor)
+
+
+def refresh_stats(cursor):
+    """Пересчитать шарды stats_counters и likes_hourly по текущим данным"""
+    cursor.execute(
+        """UPDATE stats_counter_shards s SET
+               approved_profiles = CASE WHEN s.shard = 0 THEN t.approved ELSE 0 END,
+               pending_profiles = CASE WHEN s.shard = 0 THEN t.pending ELSE 0 END,
+               rejected_profiles = CASE WHEN s.shard = 0 THEN t.rejected ELSE 0 END,
+               matches = CASE WHEN s.shard = 0 THEN t.matches ELSE 0 END,
+               pending_reports = CASE WHEN s.shard = 0 THEN t.reports ELSE 0 END
+           FROM (SELECT (SELECT COUNT(*) FROM profiles WHERE status = 'approved') AS approved,
+                        (SELECT COUNT(*) FROM profiles WHERE status = 'pending') AS pending,
+                        (SELECT COUNT(*) FROM profiles WHERE status = 'rejected') AS rejected,
+                        (SELECT COUNT(*) FROM matches) AS matches,
+                        (SELECT COUNT(*) FROM reports WHERE status = 'pending') AS reports) t"""
+    )
+    cursor.execute('DELETE FROM likes_hourly')
+    cursor.execute(
+        """INSERT INTO likes_hourly (bucket, shard, likes)
+           SELECT date_trunc('hour', created_at), from_user_id % 8, COUNT(*)
+           FROM likes
+           WHERE created_at > NOW() - INTERVAL '25 hours'
+           GROUP BY 1, 2"""
+    )
+
+
+def seed_profiles(cursor, count: int, first_id: int = 1_000_000):
+    """Заполнить profiles синтетическими анкетами (10% на модерации)"""
+    with bulk_load(cursor, 'profiles'):
+        cursor.execute(
+            """INSERT INTO profiles (telegram_id, username, name, age, city, gender, photo_url, bio, status, created_at)
+               SELECT %(first_id)s + g,
+                      'user' || g,
+                      'User ' || g,
+                      13 + g %% 7,
+                      (%(cities)s::text[])[1 + g %% array_length(%(cities)s::text[], 1)],
+                      CASE WHEN g %% 2 = 0 THEN 'male' ELSE 'female' END,
+                      'https://via.placeholder.com/400',
+                      'Bio ' || g,
+                      CASE WHEN g %% 10 = 0 THEN 'pending' ELSE 'approved' END,
+                      NOW() - (g %% 2000) * INTERVAL '1 hour'
+               FROM generate_series(1, %(count)s) g""",
+            {'first_id': first_id, 'cities': CITIES, 'count': count}
+        )
+    cursor.execute('ANALYZE')
+
+
+def seed_likes(cursor, from_user_id: int, count: int, first_id: int = 1_000_000, total: int = 0):
+    """Поставить пользователю count лайков случайным анкетам"""
+    cursor.execute(
+        """INSERT INTO likes (from_user_id, to_user_id)
+           SELECT %s, %s + (random() * %s)::bigint FROM generate_series(1, %s)
+           ON CONFLICT DO NOTHING""",
+        (from_user_id, first_id, max(total, count), count)
+    )
+
+
+def seed_activity(cursor, profiles: int, likes: int, matches: int, reports: int, first_id: int = 1_000_000):
+    """Заполнить лайки, совпадения и жалобы между синтетическими анкетами"""
+    with bulk_load(cursor, 'likes', 'matches', 'reports'):
+        cursor.execute(
+            """INSERT INTO likes (from_user_id, to_user_id, created_at)
+               SELECT %(first_id)s + 1 + (random() * (%(profiles)s - 1))::bigint,
+                      %(first_id)s + 1 + (random() * (%(profiles)s - 1))::bigint,
+                      NOW() - random() * INTERVAL '30 days'
+               FROM generate_series(1, %(count)s)
+               ON CONFLICT DO NOTHING""",
+            {'first_id': first_id, 'profiles': profiles, 'count': likes}
+        )
+        cursor.execute(
+            """INSERT INTO matches (user1_id, user2_id)
+               SELECT %(first_id)s + 1 + (random() * (%(profiles)s / 2 - 1))::bigint,
+                      %(first_id)s + %(profiles)s / 2 + 1 + (random() * (%(profiles)s / 2 - 1))::bigint
+               FROM generate_series(1, %(count)s)
+               ON CONFLICT DO NOTHING""",
+            {'first_id': first_id, 'profiles': profiles, 'count': matches}
+        )
+        cursor.execute(
+            """INSERT INTO reports (reporter_id, reported_user_id, reason, status)
+               SELECT %(first_id)s + 1 + (random() * (%(profiles)s - 1))::bigint,
+                      %(first_id)s + 1 + (random() * (%(profiles)s - 1))::bigint,
+                      'Жалоба через бота',
+                      CASE WHEN g %% 20 = 0 THEN 'pending' ELSE 'resolved' END
+               FROM generate_series(1, %(count)s) g""",
+            {'first_id': first_id, 'profiles': profiles, 'count': reports}
+        )
+    cursor.execute('ANALYZE')
+
+
+def seed_feed_state(cursor, profiles: int, queued_users: int, skips: int, quota_users: int, updates: int,
+                    first_id: int = 1_000_000, queue_batch: int = 20):
+    """Заполнить очереди ленты, пропуски, квоты лайков и журнал апдейтов"""
+    cursor.execute(
+        """INSERT INTO browse_queue (user_id, candidate_id, created_at)
+           SELECT %(first_id)s + u,
+                  %(first_id)s + 1 + (random() * (%(profiles)s - 1))::bigint,
+                  NOW() - random() * INTERVAL '1 day'
+           FROM generate_series(1, %(users)s) u, generate_series(1, %(batch)s)""",
+        {'first_id': first_id, 'profiles': profiles, 'users': queued_users, 'batch': queue_batch}
+    )
+    cursor.execute(
+        """INSERT INTO skips (user_id, skipped_user_id, created_at)
+           SELECT %(first_id)s + 1 + (random() * (%(profiles)s - 1))::bigint,
+                  %(first_id)s + 1 + (random() * (%(profiles)s - 1))::bigint,
+                  NOW() - random() * INTERVAL '30 days'
+           FROM generate_series(1, %(count)s)
+           ON CONFLICT DO NOTHING""",
+        {'first_id': first_id, 'profiles': profiles, 'count': skips}
+    )
+    cursor.execute(
+        """INSERT INTO like_quota (user_id, window_start, used)
+           SELECT %(first_id)s + u, NOW() - random() * INTERVAL '24 hours', (random() * 50)::int
+           FROM generate_series(1, %(count)s) u
+           ON CONFLICT DO NOTHING""",
+        {'first_id': first_id, 'count': quota_users}
+    )
+    cursor.execute(
+        """INSERT INTO processed_updates (update_id, processed_at, started_at)
+           SELECT g, NOW() - random() * INTERVAL '2 days', NOW() - random() * INTERVAL '2 days'
+           FROM generate_series(1, %(count)s) g
+           ON CONFLICT DO NOTHING""",
+        {'count': updates}
+    )
+    cursor.execute('ANALYZE')
+
+
+def seed_outbox(cursor, profiles: int, count: int, first_id: int = 1_000_000):
+    """Заполнить исходящую очередь: в основном отложенные ретраи и упавшие, немного готовых"""
+    cursor.execute(
+        """INSERT INTO outbox (chat_id, payload, status, attempts, next_attempt_at, created_at)
+           SELECT %(first_id)s + 1 + (random() * (%(profiles)s - 1))::bigint,
+                  jsonb_build_object('text', 'Message ' || g),
+                  CASE WHEN g %% 4 = 0 THEN 'failed' ELSE 'pending' END,
+                  g %% 8,
+                  CASE WHEN g %% 10 = 0 THEN NOW() - INTERVAL '1 second'
+                       ELSE NOW() + random() * INTERVAL '10 minutes' END,
+                  NOW() - random() * INTERVAL '1 day'
+           FROM generate_series(1, %(count)s) g""",
+        {'first_id': first_id, 'profiles': profiles, 'count': count}
+    )
+    cursor.execute('ANALYZE')
+
+
+def measure(fn: Callable[[], object], repeat: int, setup: Optional[Callable[[], object]] = None) -> List[float]:
+    """Замерить время вызовов в миллисекундах; setup перед каждым вызовом в замер не входит"""
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def summarize(timings: List[float]) -> Dict[str, float]:
+    """p50/p95/p99 по списку замеров"""
+    ordered = sorted(timings)
+    
+    def percentile(p: float) -> float:
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return ordered[index]
+    
+    return {
+        'p50': percentile(50),
+        'p95': percentile(95),
+        'p99': percentile(99),
+        'mean': statistics.fmean(ordered)
+    }
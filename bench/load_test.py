@@ -0,0 +1,286 @@
+"""
+Нагрузочный прогон webhook-обработчика бота на локальной БД и заглушке Bot API.
+
+Проигрывает синтетический поток апдейтов (команды, лайки/пропуски, создание
+анкет, модерация) через handler() и печатает по каждому типу апдейта
+p50/p95/p99, число запросов к БД, исходящих HTTP-вызовов и ответов,
+отданных в теле webhook-ответа.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python bench/load_test.py --sizes 1000,10000,100000
+
+С --concurrency > 1 апдейты обрабатываются параллельно и печатается
+пропускная способность; счётчики запросов и вызовов точны только при 1.
+Все потоки живут в одном процессе и упираются в GIL, а не в базу:
+параллельный прогон показывает конкуренцию за блокировки, но не масштабирование.
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+import psycopg2.extensions
+
+from common import apply_migrations, connect, get_database_url, load_function, seed_activity, seed_profiles, summarize
+
+SCHEMA = 'bench_load'
+FIRST_ID = 1_000_000
+ADMIN_ID = 42
+BOT_TOKEN = 'bench-token'
+
+UPDATE_MIX = [
+    ('/start', 5),
+    ('/help', 2),
+    ('/profile', 5),
+    ('/browse', 20),
+    ('/matches', 8),
+    ('like', 30),
+    ('skip', 20),
+    ('create', 3),
+    ('moderate', 3),
+    ('mod_approve', 4),
+]
+
+
+class StubTelegramAPI(BaseHTTPRequestHandler):
+    """Заглушка Bot API: отвечает ok и считает вызовы по методам"""
+    
+    # Keep-alive, как у настоящего Bot API: иначе каждый вызов открывает новое TCP-соединение
+    protocol_version = 'HTTP/1.1'
+    # Заголовки и тело уходят отдельными сегментами: с Nagle и отложенным ACK клиента каждый ответ ждёт 40 мс
+    disable_nagle_algorithm = True
+    calls: Dict[str, int] = defaultdict(int)
+    lock = threading.Lock()
+    
+    def do_POST(self):
+        method = self.path.rsplit('/', 1)[-1]
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.lock:
+            self.calls[method] += 1
+        
+        body = json.dumps({'ok': True, 'result': True}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+    
+    @classmethod
+    def total(cls) -> int:
+        with cls.lock:
+            return sum(cls.calls.values())
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """Курсор, считающий запросы к БД"""
+    
+    queries = 0
+    
+    def execute(self, query, vars=None):
+        CountingCursor.queries += 1
+        return super().execute(query, vars)
+
+
+class StubServer(ThreadingHTTPServer):
+    # При очереди accept по умолчанию (5) параллельные подключения теряют SYN и ждут повтора секунду
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def start_stub_server() -> ThreadingHTTPServer:
+    server = StubServer(('127.0.0.1', 0), StubTelegramAPI)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class UpdateFactory:
+    """Генератор синтетических апдейтов Telegram"""
+    
+    def __init__(self, size: int):
+        self.size = size
+        self.update_id = 0
+        self.message_id = 0
+        self.next_new_user = FIRST_ID + size + 1
+    
+    def random_user(self) -> int:
+        # Каждая десятая анкета в seed_profiles на модерации, берём одобренные
+        while True:
+            user_id = FIRST_ID + random.randint(1, self.size)
+            if (user_id - FIRST_ID) % 10:
+                return user_id
+    
+    def message(self, chat_id: int, text: str) -> dict:
+        self.update_id += 1
+        self.message_id += 1
+        return {
+            'update_id': self.update_id,
+            'message': {
+                'message_id': self.message_id,
+                'chat': {'id': chat_id},
+                'from': {'id': chat_id, 'username': f'user{chat_id}'},
+                'text': text
+            }
+        }
+    
+    def callback(self, chat_id: int, data: str) -> dict:
+        self.update_id += 1
+        self.message_id += 1
+        return {
+            'update_id': self.update_id,
+            'callback_query': {
+                'id': str(self.update_id),
+                'from': {'id': chat_id},
+                'data': data,
+                'message': {'message_id': self.message_id, 'chat': {'id': chat_id}}
+            }
+        }
+    
+    def build(self, kind: str, pending_ids: List[int]) -> dict:
+        if kind == 'like':
+            return self.callback(self.random_user(), f'like_{self.random_user()}')
+        if kind == 'skip':
+            return self.callback(self.random_user(), f'skip_{self.random_user()}')
+        if kind == 'create':
+            user_id = self.next_new_user
+            self.next_new_user += 1
+            return self.message(user_id, f"Bench\n{random.randint(13, 19)}\nМосква\nМ\nНагрузочный тест")
+        if kind == 'moderate':
+            return self.message(ADMIN_ID, '/moderate')
+        if kind == 'mod_approve':
+            profile_id = pending_ids.pop() if pending_ids else 1
+            return self.callback(ADMIN_ID, f'mod_approve_{profile_id}')
+        return self.message(self.random_user(), kind)
+
+
+def make_stream(factory: UpdateFactory, count: int, pending_ids: List[int]) -> List[Tuple[str, dict]]:
+    kinds = [kind for kind, _ in UPDATE_MIX]
+    weights = [weight for _, weight in UPDATE_MIX]
+    return [(kind, factory.build(kind, pending_ids)) for kind in random.choices(kinds, weights, k=count)]
+
+
+def load_bot():
+    bot = load_function('telegram-bot')
+    real_acquire = bot.acquire_connection
+    
+    def acquire_counting(db_url: str, schema: str):
+        conn = real_acquire(db_url, schema)
+        conn.cursor_factory = CountingCursor
+        return conn
+    
+    bot.acquire_connection = acquire_counting
+    return bot
+
+
+def unload_bot(bot):
+    """Закрыть ресурсы модуля бота: следующий размер загружает его заново"""
+    if bot._profile_listener_thread is not None:
+        bot._profile_listener_thread.join()
+    with bot._profile_listener_lock:
+        if bot._profile_listener is not None and not bot._profile_listener.closed:
+            bot._profile_listener.close()
+        bot._profile_listener = None
+    
+    if bot._db_pool is not None and not bot._db_pool.closed:
+        bot._db_pool.closeall()
+    if bot._telegram_executor is not None:
+        bot._telegram_executor.shutdown()
+    for client in bot._telegram_clients.values():
+        client.session.close()
+
+
+def run_size(size: int, updates: int, concurrency: int):
+    conn = connect(SCHEMA)
+    cursor = conn.cursor()
+    apply_migrations(cursor)
+    seed_profiles(cursor, size, FIRST_ID)
+    seed_activity(cursor, size, likes=size * 3, matches=size // 5, reports=size // 20, first_id=FIRST_ID)
+    cursor.execute("SELECT id FROM profiles WHERE status = 'pending' ORDER BY id")
+    pending_ids = [row[0] for row in cursor.fetchall()]
+    cursor.close()
+    conn.close()
+    
+    bot = load_bot()
+    stream = make_stream(UpdateFactory(size), updates, pending_ids)
+    
+    timings: Dict[str, List[float]] = defaultdict(list)
+    queries: Dict[str, int] = defaultdict(int)
+    http_calls: Dict[str, int] = defaultdict(int)
+    replies: Dict[str, int] = defaultdict(int)
+    errors: Dict[str, int] = defaultdict(int)
+    
+    def process(kind: str, update: dict):
+        queries_before = CountingCursor.queries
+        calls_before = StubTelegramAPI.total()
+        
+        started = time.perf_counter()
+        response = bot.handler({'httpMethod': 'POST', 'body': json.dumps(update)}, None)
+        elapsed = (time.perf_counter() - started) * 1000
+        
+        timings[kind].append(elapsed)
+        if response['statusCode'] != 200:
+            errors[kind] += 1
+        elif 'method' in json.loads(response['body']):
+            replies[kind] += 1
+        if concurrency == 1:
+            queries[kind] += CountingCursor.queries - queries_before
+            http_calls[kind] += StubTelegramAPI.total() - calls_before
+    
+    started = time.perf_counter()
+    if concurrency == 1:
+        for kind, update in stream:
+            process(kind, update)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(lambda item: process(*item), stream))
+    wall = time.perf_counter() - started
+    
+    unload_bot(bot)
+    
+    print(f"\n== {size} profiles, {updates} updates, concurrency {concurrency}: {updates / wall:.0f} updates/s")
+    print(f"{'update':<12} | {'n':>5} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8} | {'db/upd':>6} | {'http/upd':>8} | {'replies':>7} | {'errors':>6}")
+    for kind, _ in UPDATE_MIX:
+        if not timings[kind]:
+            continue
+        stats = summarize(timings[kind])
+        n = len(timings[kind])
+        db_per_update = f"{queries[kind] / n:.1f}" if concurrency == 1 else '-'
+        http_per_update = f"{http_calls[kind] / n:.1f}" if concurrency == 1 else '-'
+        print(f"{kind:<12} | {n:>5} | {stats['p50']:>8.2f} | {stats['p95']:>8.2f} | {stats['p99']:>8.2f} | "
+              f"{db_per_update:>6} | {http_per_update:>8} | {replies[kind]:>7} | {errors[kind]:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    
+    random.seed(args.seed)
+    server = start_stub_server()
+    
+    os.environ['TELEGRAM_API_URL'] = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ['TELEGRAM_BOT_TOKEN'] = BOT_TOKEN
+    os.environ['DATABASE_URL'] = get_database_url()
+    os.environ['MAIN_DB_SCHEMA'] = SCHEMA
+    os.environ['ADMIN_TELEGRAM_ID'] = str(ADMIN_ID)
+    # Одно соединение инстанса занимает слушатель кэша анкет
+    os.environ['DB_POOL_MAX_SIZE'] = str(max(4, args.concurrency + 1))
+    
+    for size in (int(value) for value in args.sizes.split(',')):
+        run_size(size, args.updates, args.concurrency)
+    
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Бенчмарк ранжирования ленты: скоринг пачки кандидатов одним векторным проходом.
+
+    python bench/ranking.py --sizes 500,2000,5000,10000 --budget-ms 5
+
+База не нужна: кандидаты синтетические, в том же виде, что отдаёт fetch_candidates.
+Код выхода 1, если p95 хотя бы одного размера пачки выше бюджета.
+"""
+import argparse
+import random
+import sys
+from typing import List
+
+from common import load_function, measure, summarize
+
+
+def make_candidates(size: int) -> List[tuple]:
+    """Кандидаты с признаками: возраст, тот же город, дни с создания, часы простоя"""
+    return [
+        (
+            1_000_000 + i,
+            random.randint(13, 19),
+            int(random.random() < 0.2),
+            random.uniform(0, 365),
+            random.uniform(0, 500) if random.random() < 0.6 else 1e6
+        )
+        for i in range(size)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', default='500,2000,5000,10000')
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--budget-ms', type=float, default=5.0)
+    args = parser.parse_args()
+    
+    bot = load_function('telegram-bot')
+    over_budget = False
+    
+    print(f"{'batch':>8} | {'p50 ms':>8} | {'p95 ms':>8} | {'p99 ms':>8}")
+    for size in (int(value) for value in args.sizes.split(',')):
+        candidates = make_candidates(size)
+        stats = summarize(measure(
+            lambda: bot.rank_candidates(candidates, 16, bot.BROWSE_QUEUE_BATCH), args.repeat
+        ))
+        print(f"{size:>8} | {stats['p50']:>8.2f} | {stats['p95']:>8.2f} | {stats['p99']:>8.2f}")
+        over_budget = over_budget or stats['p95'] > args.budget_ms
+    
+    if over_budget:
+        print(f"\np95 выше бюджета {args.budget_ms} мс")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
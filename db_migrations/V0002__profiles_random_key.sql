@@ -0,0 +1,5 @@
+-- Случайный ключ для выбора анкеты без ORDER BY RANDOM()
+ALTER TABLE profiles ADD COLUMN IF NOT EXISTS random_key DOUBLE PRECISION NOT NULL DEFAULT random();
+
+-- Выборка одобренных анкет по случайной точке ключа
+CREATE INDEX IF NOT EXISTS idx_profiles_approved_random_key ON profiles(random_key) WHERE status = 'approved';
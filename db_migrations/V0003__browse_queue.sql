@@ -0,0 +1,13 @@
+-- Очередь заранее подобранных анкет для просмотра
+CREATE TABLE IF NOT EXISTS browse_queue (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL REFERENCES profiles(telegram_id) ON DELETE CASCADE,
+    candidate_id BIGINT NOT NULL REFERENCES profiles(telegram_id) ON DELETE CASCADE,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Снятие головы очереди пользователя
+CREATE INDEX IF NOT EXISTS idx_browse_queue_user ON browse_queue(user_id, id);
+
+-- Удаление отклонённой анкеты из всех очередей
+CREATE INDEX IF NOT EXISTS idx_browse_queue_candidate ON browse_queue(candidate_id);
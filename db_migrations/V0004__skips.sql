@@ -0,0 +1,7 @@
+-- Пропущенные анкеты: не показываются повторно, пока запись не устарела
+CREATE TABLE IF NOT EXISTS skips (
+    user_id BIGINT NOT NULL,
+    skipped_user_id BIGINT NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, skipped_user_id)
+);
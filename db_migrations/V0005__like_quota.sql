@@ -0,0 +1,14 @@
+-- Счётчик дневной квоты лайков: одна строка на пользователя
+CREATE TABLE IF NOT EXISTS like_quota (
+    user_id BIGINT PRIMARY KEY,
+    window_start TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    used INTEGER NOT NULL DEFAULT 0
+);
+
+-- Перенос лайков за последние сутки
+INSERT INTO like_quota (user_id, window_start, used)
+SELECT from_user_id, MIN(created_at), COUNT(*)
+FROM likes
+WHERE created_at > NOW() - INTERVAL '24 hours'
+GROUP BY from_user_id
+ON CONFLICT (user_id) DO NOTHING;
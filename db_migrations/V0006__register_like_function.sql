@@ -0,0 +1,57 @@
+-- Лайк, списание квоты, проверка взаимности и создание совпадения за один вызов
+CREATE OR REPLACE FUNCTION register_like(p_from BIGINT, p_to BIGINT, p_limit INTEGER, p_window INTERVAL)
+RETURNS TABLE (
+    likes_used INTEGER,
+    already_liked BOOLEAN,
+    is_mutual BOOLEAN,
+    target_name VARCHAR,
+    target_username VARCHAR
+)
+LANGUAGE plpgsql AS $$
+BEGIN
+    -- Встречные лайки одной пары выполняются по очереди и всегда видят друг друга
+    PERFORM pg_advisory_xact_lock(hashtextextended(LEAST(p_from, p_to) || ':' || GREATEST(p_from, p_to), 0));
+
+    is_mutual := FALSE;
+    already_liked := EXISTS (SELECT 1 FROM likes l WHERE l.from_user_id = p_from AND l.to_user_id = p_to);
+
+    IF already_liked THEN
+        SELECT q.used INTO likes_used
+        FROM like_quota q
+        WHERE q.user_id = p_from AND q.window_start > NOW() - p_window;
+        likes_used := COALESCE(likes_used, 0);
+        RETURN NEXT;
+        RETURN;
+    END IF;
+
+    INSERT INTO like_quota AS q (user_id, window_start, used)
+    VALUES (p_from, NOW(), 1)
+    ON CONFLICT (user_id) DO UPDATE SET
+        window_start = CASE WHEN q.window_start <= NOW() - p_window THEN NOW() ELSE q.window_start END,
+        used = CASE WHEN q.window_start <= NOW() - p_window THEN 1 ELSE q.used + 1 END
+    WHERE q.window_start <= NOW() - p_window OR q.used < p_limit
+    RETURNING q.used INTO likes_used;
+
+    -- Квота исчерпана
+    IF likes_used IS NULL THEN
+        RETURN NEXT;
+        RETURN;
+    END IF;
+
+    INSERT INTO likes (from_user_id, to_user_id) VALUES (p_from, p_to) ON CONFLICT DO NOTHING;
+
+    is_mutual := EXISTS (SELECT 1 FROM likes l WHERE l.from_user_id = p_to AND l.to_user_id = p_from);
+
+    IF is_mutual THEN
+        INSERT INTO matches (user1_id, user2_id)
+        VALUES (LEAST(p_from, p_to), GREATEST(p_from, p_to))
+        ON CONFLICT DO NOTHING;
+
+        SELECT p.name, p.username INTO target_name, target_username
+        FROM profiles p
+        WHERE p.telegram_id = p_to;
+    END IF;
+
+    RETURN NEXT;
+END;
+$$;
@@ -0,0 +1,4 @@
+-- Совпадения пользователя с каждой стороны пары, от новых к старым,
+-- без обращения к таблице
+CREATE INDEX IF NOT EXISTS idx_matches_user1_recent ON matches(user1_id, id DESC) INCLUDE (user2_id);
+CREATE INDEX IF NOT EXISTS idx_matches_user2_recent ON matches(user2_id, id DESC) INCLUDE (user1_id);
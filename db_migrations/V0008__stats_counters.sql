@@ -0,0 +1,139 @@
+-- Счётчики для статистики, поддерживаются триггерами
+CREATE TABLE IF NOT EXISTS stats_counters (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    approved_profiles BIGINT NOT NULL DEFAULT 0,
+    pending_profiles BIGINT NOT NULL DEFAULT 0,
+    rejected_profiles BIGINT NOT NULL DEFAULT 0,
+    matches BIGINT NOT NULL DEFAULT 0,
+    pending_reports BIGINT NOT NULL DEFAULT 0
+);
+
+-- Лайки по часам; shard разносит запись по нескольким строкам часа
+CREATE TABLE IF NOT EXISTS likes_hourly (
+    bucket TIMESTAMP NOT NULL,
+    shard SMALLINT NOT NULL,
+    likes BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, shard)
+);
+
+CREATE OR REPLACE FUNCTION stats_profiles_changed() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    d_approved INTEGER := 0;
+    d_pending INTEGER := 0;
+    d_rejected INTEGER := 0;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        d_approved := d_approved - (OLD.status = 'approved')::INTEGER;
+        d_pending := d_pending - (OLD.status = 'pending')::INTEGER;
+        d_rejected := d_rejected - (OLD.status = 'rejected')::INTEGER;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        d_approved := d_approved + (NEW.status = 'approved')::INTEGER;
+        d_pending := d_pending + (NEW.status = 'pending')::INTEGER;
+        d_rejected := d_rejected + (NEW.status = 'rejected')::INTEGER;
+    END IF;
+
+    UPDATE stats_counters SET
+        approved_profiles = approved_profiles + d_approved,
+        pending_profiles = pending_profiles + d_pending,
+        rejected_profiles = rejected_profiles + d_rejected;
+
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION stats_matches_changed() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE stats_counters SET matches = matches + CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION stats_reports_changed() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    d_pending INTEGER := 0;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        d_pending := d_pending - (OLD.status = 'pending')::INTEGER;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        d_pending := d_pending + (NEW.status = 'pending')::INTEGER;
+    END IF;
+
+    IF d_pending <> 0 THEN
+        UPDATE stats_counters SET pending_reports = pending_reports + d_pending;
+    END IF;
+
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION stats_likes_changed() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO likes_hourly (bucket, shard, likes)
+        VALUES (date_trunc('hour', NEW.created_at), NEW.from_user_id % 8, 1)
+        ON CONFLICT (bucket, shard) DO UPDATE SET likes = likes_hourly.likes + 1;
+    ELSE
+        UPDATE likes_hourly SET likes = likes - 1
+        WHERE bucket = date_trunc('hour', OLD.created_at) AND shard = OLD.from_user_id % 8;
+    END IF;
+
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_stats_profiles_insert_delete ON profiles;
+CREATE TRIGGER trg_stats_profiles_insert_delete
+    AFTER INSERT OR DELETE ON profiles
+    FOR EACH ROW EXECUTE FUNCTION stats_profiles_changed();
+
+DROP TRIGGER IF EXISTS trg_stats_profiles_status ON profiles;
+CREATE TRIGGER trg_stats_profiles_status
+    AFTER UPDATE OF status ON profiles
+    FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status)
+    EXECUTE FUNCTION stats_profiles_changed();
+
+DROP TRIGGER IF EXISTS trg_stats_matches ON matches;
+CREATE TRIGGER trg_stats_matches
+    AFTER INSERT OR DELETE ON matches
+    FOR EACH ROW EXECUTE FUNCTION stats_matches_changed();
+
+DROP TRIGGER IF EXISTS trg_stats_reports_insert_delete ON reports;
+CREATE TRIGGER trg_stats_reports_insert_delete
+    AFTER INSERT OR DELETE ON reports
+    FOR EACH ROW EXECUTE FUNCTION stats_reports_changed();
+
+DROP TRIGGER IF EXISTS trg_stats_reports_status ON reports;
+CREATE TRIGGER trg_stats_reports_status
+    AFTER UPDATE OF status ON reports
+    FOR EACH ROW WHEN (OLD.status IS DISTINCT FROM NEW.status)
+    EXECUTE FUNCTION stats_reports_changed();
+
+DROP TRIGGER IF EXISTS trg_stats_likes ON likes;
+CREATE TRIGGER trg_stats_likes
+    AFTER INSERT OR DELETE ON likes
+    FOR EACH ROW EXECUTE FUNCTION stats_likes_changed();
+
+-- Начальные значения из текущих данных
+INSERT INTO stats_counters (id, approved_profiles, pending_profiles, rejected_profiles, matches, pending_reports)
+SELECT TRUE,
+       (SELECT COUNT(*) FROM profiles WHERE status = 'approved'),
+       (SELECT COUNT(*) FROM profiles WHERE status = 'pending'),
+       (SELECT COUNT(*) FROM profiles WHERE status = 'rejected'),
+       (SELECT COUNT(*) FROM matches),
+       (SELECT COUNT(*) FROM reports WHERE status = 'pending')
+ON CONFLICT (id) DO NOTHING;
+
+INSERT INTO likes_hourly (bucket, shard, likes)
+SELECT date_trunc('hour', created_at), from_user_id % 8, COUNT(*)
+FROM likes
+WHERE created_at > NOW() - INTERVAL '25 hours'
+GROUP BY 1, 2
+ON CONFLICT (bucket, shard) DO NOTHING;
@@ -0,0 +1,10 @@
+-- Аренда элементов очереди модерации: кто взял и до какого времени
+ALTER TABLE profiles ADD COLUMN IF NOT EXISTS claimed_by BIGINT;
+ALTER TABLE profiles ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP;
+
+ALTER TABLE reports ADD COLUMN IF NOT EXISTS claimed_by BIGINT;
+ALTER TABLE reports ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP;
+
+-- Очереди модерации: только ожидающие элементы, по времени создания
+CREATE INDEX IF NOT EXISTS idx_profiles_pending_created ON profiles(created_at, id) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_reports_pending_created ON reports(created_at, id) WHERE status = 'pending';
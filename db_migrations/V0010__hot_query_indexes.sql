@@ -0,0 +1,14 @@
+-- Дублируют ограничения UNIQUE(telegram_id), UNIQUE(user1_id, user2_id)
+-- и префикс UNIQUE(from_user_id, to_user_id)
+DROP INDEX IF EXISTS idx_profiles_telegram_id;
+DROP INDEX IF EXISTS idx_matches_users;
+DROP INDEX IF EXISTS idx_likes_from_user;
+
+-- Заменены частичными индексами очередей модерации и выдачи анкет
+DROP INDEX IF EXISTS idx_profiles_status;
+DROP INDEX IF EXISTS idx_reports_status;
+
+-- Входящие лайки пользователя с проверкой обратного лайка без обращения к таблице
+CREATE INDEX IF NOT EXISTS idx_likes_to_user_from ON likes(to_user_id, from_user_id);
+DROP INDEX IF EXISTS idx_likes_to_user;
+
@@ -0,0 +1,22 @@
+-- Принятые апдейты Telegram для отсева повторных доставок вебхука
+CREATE TABLE IF NOT EXISTS processed_updates (
+    update_id BIGINT PRIMARY KEY,
+    processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Очистка устаревших записей
+CREATE INDEX IF NOT EXISTS idx_processed_updates_processed_at ON processed_updates(processed_at);
+
+-- Уже накопившиеся повторные жалобы на того же человека закрываются
+UPDATE reports r SET status = 'dismissed'
+WHERE r.status = 'pending'
+AND EXISTS (
+    SELECT 1 FROM reports o
+    WHERE o.status = 'pending'
+    AND o.reporter_id = r.reporter_id
+    AND o.reported_user_id = r.reported_user_id
+    AND o.id < r.id
+);
+
+-- Не больше одной активной жалобы от пользователя на одного человека
+CREATE UNIQUE INDEX IF NOT EXISTS idx_reports_pending_pair ON reports(reporter_id, reported_user_id) WHERE status = 'pending';
@@ -0,0 +1,18 @@
+-- Очередь исходящих сообщений Bot API: обработчики кладут, воркер отправляет с учётом лимитов Telegram
+CREATE TABLE IF NOT EXISTS outbox (
+    id BIGSERIAL PRIMARY KEY,
+    chat_id BIGINT NOT NULL,
+    method VARCHAR(64) NOT NULL DEFAULT 'sendMessage',
+    payload JSONB NOT NULL,
+    status VARCHAR(20) DEFAULT 'pending' CHECK (status IN ('pending', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Выборка готовых к отправке сообщений
+CREATE INDEX IF NOT EXISTS idx_outbox_pending_due ON outbox(next_attempt_at, id) WHERE status = 'pending';
+
+-- Очерёдность внутри чата и сдвиг следующего сообщения чата после отправки
+CREATE INDEX IF NOT EXISTS idx_outbox_pending_chat ON outbox(chat_id, id) WHERE status = 'pending';
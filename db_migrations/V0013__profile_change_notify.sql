@@ -0,0 +1,24 @@
+-- Уведомление об изменении анкеты: инстансы бота сбрасывают её из своего кэша
+CREATE OR REPLACE FUNCTION notify_profile_changed() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('profile_changed', OLD.telegram_id::TEXT);
+    ELSE
+        PERFORM pg_notify('profile_changed', NEW.telegram_id::TEXT);
+    END IF;
+
+    RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_profiles_notify_insert_delete ON profiles;
+CREATE TRIGGER trg_profiles_notify_insert_delete
+    AFTER INSERT OR DELETE ON profiles
+    FOR EACH ROW EXECUTE FUNCTION notify_profile_changed();
+
+DROP TRIGGER IF EXISTS trg_profiles_notify_update ON profiles;
+CREATE TRIGGER trg_profiles_notify_update
+    AFTER UPDATE ON profiles
+    FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*)
+    EXECUTE FUNCTION notify_profile_changed();
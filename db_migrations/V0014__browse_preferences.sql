@@ -0,0 +1,18 @@
+-- Предпочтения ленты: пол, возрастное окно и только свой город
+ALTER TABLE profiles ADD COLUMN IF NOT EXISTS pref_gender VARCHAR(10) CHECK (pref_gender IN ('male', 'female'));
+ALTER TABLE profiles ADD COLUMN IF NOT EXISTS pref_age_min INTEGER CHECK (pref_age_min BETWEEN 13 AND 19);
+ALTER TABLE profiles ADD COLUMN IF NOT EXISTS pref_age_max INTEGER CHECK (pref_age_max BETWEEN 13 AND 19);
+ALTER TABLE profiles ADD COLUMN IF NOT EXISTS pref_same_city BOOLEAN NOT NULL DEFAULT FALSE;
+
+-- Город вводится руками: «Москва », «москва» и «МОСКВА» — один город
+CREATE OR REPLACE FUNCTION normalize_city(city TEXT) RETURNS TEXT
+LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+    SELECT replace(lower(btrim(city)), 'ё', 'е')
+$$;
+
+ALTER TABLE profiles ADD COLUMN IF NOT EXISTS city_norm TEXT GENERATED ALWAYS AS (normalize_city(city)) STORED;
+
+-- Лента с фильтром по городу (и полу) и лента с фильтром только по полу,
+-- обе с обходом по random_key от случайной точки
+CREATE INDEX IF NOT EXISTS idx_profiles_feed_city ON profiles(city_norm, gender, random_key) WHERE status = 'approved';
+CREATE INDEX IF NOT EXISTS idx_profiles_feed_gender ON profiles(gender, random_key) WHERE status = 'approved';
@@ -0,0 +1,6 @@
+-- Состояние обработки апдейта: повтор завершённого получает сохранённый ответ,
+-- а зависшую обработку (функцию убили по таймауту) можно забрать заново
+ALTER TABLE processed_updates ADD COLUMN IF NOT EXISTS state VARCHAR(20) NOT NULL DEFAULT 'done'
+    CHECK (state IN ('processing', 'done'));
+ALTER TABLE processed_updates ADD COLUMN IF NOT EXISTS started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE processed_updates ADD COLUMN IF NOT EXISTS response JSONB;
@@ -0,0 +1,9 @@
+-- Общий для всех инстансов бюджет отправки из очереди: токен-бакет в одной строке,
+-- списывается тем же запросом, что берёт сообщения в отправку
+CREATE TABLE IF NOT EXISTS outbox_rate (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    tokens DOUBLE PRECISION NOT NULL DEFAULT 0,
+    refilled_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO outbox_rate (id) VALUES (TRUE) ON CONFLICT (id) DO NOTHING;
@@ -0,0 +1,177 @@
+-- Счётчики статистики разнесены по строкам: одна строка stats_counters была общей точкой
+-- блокировки для всех вставок анкет, смен статуса и совпадений, включая транзакцию register_like.
+-- Сеанс пишет в строку по своему pid, триггеры уровня оператора дают одну запись на оператор
+CREATE TABLE IF NOT EXISTS stats_counter_shards (
+    shard SMALLINT PRIMARY KEY,
+    approved_profiles BIGINT NOT NULL DEFAULT 0,
+    pending_profiles BIGINT NOT NULL DEFAULT 0,
+    rejected_profiles BIGINT NOT NULL DEFAULT 0,
+    matches BIGINT NOT NULL DEFAULT 0,
+    pending_reports BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO stats_counter_shards (shard) SELECT generate_series(0, 15) ON CONFLICT (shard) DO NOTHING;
+
+UPDATE stats_counter_shards s SET
+    approved_profiles = c.approved_profiles,
+    pending_profiles = c.pending_profiles,
+    rejected_profiles = c.rejected_profiles,
+    matches = c.matches,
+    pending_reports = c.pending_reports
+FROM stats_counters c
+WHERE s.shard = 0;
+
+DROP TRIGGER IF EXISTS trg_stats_profiles_insert_delete ON profiles;
+DROP TRIGGER IF EXISTS trg_stats_profiles_status ON profiles;
+DROP TRIGGER IF EXISTS trg_stats_matches ON matches;
+DROP TRIGGER IF EXISTS trg_stats_reports_insert_delete ON reports;
+DROP TRIGGER IF EXISTS trg_stats_reports_status ON reports;
+DROP FUNCTION IF EXISTS stats_profiles_changed();
+DROP FUNCTION IF EXISTS stats_matches_changed();
+DROP FUNCTION IF EXISTS stats_reports_changed();
+
+-- Читатели по-прежнему берут одну строку stats_counters
+DROP TABLE stats_counters;
+CREATE VIEW stats_counters AS
+SELECT SUM(approved_profiles)::BIGINT AS approved_profiles,
+       SUM(pending_profiles)::BIGINT AS pending_profiles,
+       SUM(rejected_profiles)::BIGINT AS rejected_profiles,
+       SUM(matches)::BIGINT AS matches,
+       SUM(pending_reports)::BIGINT AS pending_reports
+FROM stats_counter_shards;
+
+CREATE OR REPLACE FUNCTION stats_add(d_approved BIGINT, d_pending BIGINT, d_rejected BIGINT,
+                                     d_matches BIGINT, d_reports BIGINT) RETURNS void
+LANGUAGE sql AS $$
+    UPDATE stats_counter_shards SET
+        approved_profiles = approved_profiles + d_approved,
+        pending_profiles = pending_profiles + d_pending,
+        rejected_profiles = rejected_profiles + d_rejected,
+        matches = matches + d_matches,
+        pending_reports = pending_reports + d_reports
+    WHERE shard = pg_backend_pid() % 16
+    AND (d_approved, d_pending, d_rejected, d_matches, d_reports) <> (0, 0, 0, 0, 0);
+$$;
+
+CREATE OR REPLACE FUNCTION stats_profiles_changed() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    d_approved BIGINT := 0;
+    d_pending BIGINT := 0;
+    d_rejected BIGINT := 0;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        SELECT d_approved - COUNT(*) FILTER (WHERE status = 'approved'),
+               d_pending - COUNT(*) FILTER (WHERE status = 'pending'),
+               d_rejected - COUNT(*) FILTER (WHERE status = 'rejected')
+        INTO d_approved, d_pending, d_rejected
+        FROM old_rows;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT d_approved + COUNT(*) FILTER (WHERE status = 'approved'),
+               d_pending + COUNT(*) FILTER (WHERE status = 'pending'),
+               d_rejected + COUNT(*) FILTER (WHERE status = 'rejected')
+        INTO d_approved, d_pending, d_rejected
+        FROM new_rows;
+    END IF;
+
+    PERFORM stats_add(d_approved, d_pending, d_rejected, 0, 0);
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION stats_matches_changed() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    d_matches BIGINT;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT COUNT(*) INTO d_matches FROM new_rows;
+    ELSE
+        SELECT -COUNT(*) INTO d_matches FROM old_rows;
+    END IF;
+
+    PERFORM stats_add(0, 0, 0, d_matches, 0);
+    RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION stats_reports_changed() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    d_pending BIGINT := 0;
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        SELECT d_pending - COUNT(*) FILTER (WHERE status = 'pending') INTO d_pending FROM old_rows;
+    END IF;
+
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT d_pending + COUNT(*) FILTER (WHERE status = 'pending') INTO d_pending FROM new_rows;
+    END IF;
+
+    PERFORM stats_add(0, 0, 0, 0, d_pending);
+    RETURN NULL;
+END;
+$$;
+
+-- Переходные таблицы не допускают нескольких событий и списка колонок в одном триггере
+CREATE TRIGGER trg_stats_profiles_insert
+    AFTER INSERT ON profiles REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_profiles_changed();
+
+CREATE TRIGGER trg_stats_profiles_update
+    AFTER UPDATE ON profiles REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_profiles_changed();
+
+CREATE TRIGGER trg_stats_profiles_delete
+    AFTER DELETE ON profiles REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_profiles_changed();
+
+CREATE TRIGGER trg_stats_matches_insert
+    AFTER INSERT ON matches REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_matches_changed();
+
+CREATE TRIGGER trg_stats_matches_delete
+    AFTER DELETE ON matches REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_matches_changed();
+
+CREATE TRIGGER trg_stats_reports_insert
+    AFTER INSERT ON reports REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_reports_changed();
+
+CREATE TRIGGER trg_stats_reports_update
+    AFTER UPDATE ON reports REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_reports_changed();
+
+CREATE TRIGGER trg_stats_reports_delete
+    AFTER DELETE ON reports REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_reports_changed();
+
+-- Статистика читает только последние сутки: первая запись в новый час чистит старые часы своего шарда
+CREATE OR REPLACE FUNCTION stats_likes_changed() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    new_bucket BOOLEAN;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO likes_hourly (bucket, shard, likes)
+        VALUES (date_trunc('hour', NEW.created_at), NEW.from_user_id % 8, 1)
+        ON CONFLICT (bucket, shard) DO UPDATE SET likes = likes_hourly.likes + 1
+        RETURNING xmax = 0 INTO new_bucket;
+
+        IF new_bucket THEN
+            DELETE FROM likes_hourly
+            WHERE bucket < date_trunc('hour', NEW.created_at) - INTERVAL '25 hours'
+            AND shard = NEW.from_user_id % 8;
+        END IF;
+    ELSE
+        UPDATE likes_hourly SET likes = likes - 1
+        WHERE bucket = date_trunc('hour', OLD.created_at) AND shard = OLD.from_user_id % 8;
+    END IF;
+
+    RETURN NULL;
+END;
+$$;
+
+DELETE FROM likes_hourly WHERE bucket < date_trunc('hour', NOW()) - INTERVAL '25 hours';